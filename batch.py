@@ -0,0 +1,181 @@
+import argparse
+import io
+import json
+import os
+import re
+import sys
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import pandas as pd
+import svgpanels
+from graphicalpivots import compile_spec, PartitionEngine
+from paneltree import PanelTree
+
+# Generates many diagrams of one dataset and specification, one per root query or
+# filter - say one per line of business. The data is factorized once per process
+# by a shared PartitionEngine, so each diagram only selects its root rows and
+# splits them; fonts and text measurements are shared through svgpanels.font_cache,
+# whose memo is handed to every worker. Diagrams are written, as they complete and
+# in job order, into a directory or a zip archive.
+
+formats = { "svg" : ".svg", "compact" : ".svg", "svgz" : ".svgz", "png" : ".png" }
+
+_worker = {}
+
+
+def filter_query(filters):
+    # A DataFrame.eval query selecting rows whose fields equal the values of filters,
+    # or are among them where a value is a list
+    clauses = []
+    for f,v in filters.items():
+        if isinstance(v, (list, tuple, set)):
+            clauses.append(f"(`{f}` in {list(v)!r})")
+        else:
+            clauses.append(f"(`{f}` == {v!r})")
+    return " and ".join(clauses) if clauses else None
+
+def jobs_by(data, fields):
+    # One (name, query) job per distinct combination of fields in data
+    fields = [fields] if isinstance(fields, str) else list(fields)
+    keys = data[fields].drop_duplicates().dropna().itertuples(index=False, name=None)
+    return [(" ".join(str(k) for k in key), filter_query(dict(zip(fields, key)))) for key in sorted(keys, key=str)]
+
+def as_job(job):
+    # Jobs are (name, query) pairs, or dicts with a name and a query or filters
+    if isinstance(job, dict):
+        return job["name"], job.get("query", filter_query(job.get("filters", {})))
+    return tuple(job)
+
+def file_name(name, fmt):
+    return (re.sub(r"[^\w.-]+", "_", str(name)).strip("_") or "diagram") + formats[fmt]
+
+def _init(data, specification, styles, settings, memo):
+    _worker.update(data=data, specification=specification, styles=styles, settings=settings,
+                   plan=compile_spec(specification, styles), engine=PartitionEngine(data))
+    svgpanels.arial = settings["font"]
+    svgpanels.font_cache.memo.update(memo)
+
+def _render(job):
+    name, query = job
+    w, settings = _worker, _worker["settings"]
+    width, height = settings["width"], settings["height"]
+    start = time.perf_counter()
+    tree = PanelTree.build(w["data"], w["specification"], w["styles"], settings["template"], query,
+                           0.0, 0.0, width, height, plan=w["plan"], engine=w["engine"])
+    built = time.perf_counter()
+    fp = io.BytesIO()
+    window = (0, 0, width, height, width, height)
+    fmt = settings["format"]
+    if fmt == "png":
+        import rasterpanels
+        rasterpanels.write_png(fp, tree.paint_order(), *window)
+    elif fmt == "svg":
+        svgpanels.write_svg(fp, tree.paint_order(), *window, settings["oversize_method"], encoding="utf-8",
+                            fitted=settings["fitted"])
+    else:
+        target = gzip.GzipFile(fileobj=fp, mode="wb", mtime=0) if fmt == "svgz" else fp
+        svgpanels.write_compact_svg(target, tree.paint_order(), *window, settings["oversize_method"],
+                                    svgpanels.CompactSVG(w["styles"]), encoding="utf-8", fitted=settings["fitted"])
+        if fmt == "svgz":
+            target.close()
+    done = time.perf_counter()
+    content = fp.getvalue()
+    return { "name" : name, "query" : query, "file" : file_name(name, fmt), "rows" : int(tree.count[0]),
+             "panels" : len(tree), "build_seconds" : built - start, "render_seconds" : done - built,
+             "bytes" : len(content) }, content
+
+def generate(data, specification, styles, jobs, output, fmt="svg", width=1600.0, height=1200.0, template="root",
+             oversize_method="truncate", max_workers=None, fitted=True):
+    """Renders a diagram of data per job into output, a directory or a path ending in
+    .zip, returning a timing summary with a record per diagram, which is also saved
+    as summary.json. fmt is one of svg, compact, svgz or png. With max_workers of 1
+    everything runs in this process; otherwise jobs are spread over a process pool.
+    fitted fits every diagram's titles at once with svgpanels.fit_text; turn it off
+    to fit them one at a time with PIL, as write_svg does by default."""
+    if fmt not in formats:
+        raise ValueError(f"Unknown format {fmt!r}, expected one of {sorted(formats)}")
+    jobs = [as_job(j) for j in jobs]
+    names = [file_name(name, fmt) for name, query in jobs]
+    if len(set(names)) != len(names):
+        raise ValueError("Job names must give distinct file names")
+    settings = { "width" : width, "height" : height, "template" : template, "format" : fmt,
+                 "oversize_method" : oversize_method, "font" : svgpanels.arial, "fitted" : fitted }
+    initargs = (data, specification, styles, settings, dict(svgpanels.font_cache.memo))
+    archive = zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) if output.endswith(".zip") else None
+    if archive is None:
+        os.makedirs(output, exist_ok=True)
+    start = time.perf_counter()
+    summary = []
+    executor = None
+    try:
+        if max_workers == 1:
+            _init(*initargs)
+            results = map(_render, jobs)
+        else:
+            executor = ProcessPoolExecutor(max_workers, initializer=_init, initargs=initargs)
+            results = executor.map(_render, jobs)
+        for record, content in results:
+            if archive is None:
+                with open(os.path.join(output, record["file"]), "wb") as fp:
+                    fp.write(content)
+            else:
+                archive.writestr(record["file"], content)
+            summary.append(record)
+        report = { "diagrams" : summary, "total_seconds" : time.perf_counter() - start, "workers" : max_workers }
+        report = json.dumps(report, indent=1)
+        if archive is None:
+            with open(os.path.join(output, "summary.json"), "w") as j:
+                j.write(report)
+        else:
+            archive.writestr("summary.json", report)
+    finally:
+        # A failed job leaves the rest queued, so cancel them rather than wait
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+        if archive is not None:
+            archive.close()
+    return summary
+
+def print_summary(summary, file=sys.stderr):
+    for r in summary:
+        print(f"{r['file']:<40} {r['rows']:>8} rows {r['panels']:>6} panels "
+              f"build {r['build_seconds']:.3f}s render {r['render_seconds']:.3f}s {r['bytes']:>10} bytes", file=file)
+    print(f"{len(summary)} diagrams, build {sum(r['build_seconds'] for r in summary):.3f}s, "
+          f"render {sum(r['render_seconds'] for r in summary):.3f}s", file=file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generates a diagram per query or filter of one dataset")
+    parser.add_argument("spec", help="JSON template specification")
+    parser.add_argument("data", help="CSV data")
+    parser.add_argument("-o", "--output", required=True, help="output directory, or a .zip archive")
+    parser.add_argument("--styles", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "styles.json"))
+    parser.add_argument("--by", nargs="+", help="fields to generate one diagram per distinct value of")
+    parser.add_argument("--jobs", help="JSON list of {name, query} or {name, filters} jobs")
+    parser.add_argument("--format", default="svg", choices=sorted(formats))
+    parser.add_argument("--width", type=float, default=1600.0)
+    parser.add_argument("--height", type=float, default=1200.0)
+    parser.add_argument("--template", default="root")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--font", help="TrueType font used to measure text, in place of svgpanels.arial")
+    parser.add_argument("--exact-text", action="store_true", help="fit each title with PIL rather than from glyph tables")
+    args = parser.parse_args()
+    if args.font:
+        svgpanels.arial = args.font
+    with open(args.spec, "r") as j:
+        specification = json.load(j)
+    with open(args.styles, "r") as j:
+        styles = json.load(j)
+    data = pd.read_csv(args.data)
+    jobs = []
+    if args.jobs:
+        with open(args.jobs, "r") as j:
+            jobs.extend(json.load(j))
+    if args.by:
+        jobs.extend(jobs_by(data, args.by))
+    if not jobs:
+        parser.error("give --by fields or a --jobs file")
+    print_summary(generate(data, specification, styles, jobs, args.output, args.format, args.width, args.height,
+                           args.template, max_workers=args.workers, fitted=not args.exact_text))
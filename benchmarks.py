@@ -0,0 +1,221 @@
+import argparse
+import io
+import json
+import os
+import platform
+import string
+import subprocess
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import svgpanels
+from graphicalpivots import Panel
+from paneltree import PanelTree
+
+# Times and memory-profiles the hot paths - genchildren, walk_children, get_label,
+# text_rectangle and full SVG rendering, plus the PanelTree build - over synthetic
+# hierarchies of increasing size, and saves the results as JSON so that runs from
+# different versions can be compared with --compare. Stages that measure text are
+# timed from a fresh svgpanels.font_cache on every repetition, so that loading
+# fonts and measuring text count, and again with it warm as {stage}_warm.
+# --startup instead times importing the core modules in fresh interpreters, and
+# fails if any of them loads pandas, networkx or PIL before it is needed.
+
+layouts = ("columns", "rows", "block", "fill", "matrix")
+styles_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "styles.json")
+
+
+def synthetic_hierarchy(rows, depth=3, fanout=5, skew=1.0, label_length=12, seed=0):
+    """A DataFrame of rows rows with one column per level, level0 to level{depth-1}.
+    Each level splits every group of the level above into up to fanout children,
+    chosen with Zipf-like weights 1/(k+1)**skew, so skew=0 gives even groups. Values
+    are label_length character strings, unique to their parent, with spaces in
+    them so that labels can wrap. A band column, of up to fanout values, is the
+    second field of matrix levels, and an __all__ column holds True."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, fanout+1) ** skew
+    weights = weights / weights.sum()
+    alphabet = np.array(list(string.ascii_lowercase + "    "))
+    data = {}
+    code = np.zeros(rows, dtype=np.int64)
+    for level in range(depth):
+        code = code * fanout + rng.choice(fanout, size=rows, p=weights)
+        uniques, inverse = np.unique(code, return_inverse=True)
+        names = [f"L{level}-{c} " for c in uniques.tolist()]
+        names = np.array([(n + "".join(rng.choice(alphabet, size=max(label_length-len(n), 0))))[:label_length]
+                          for n in names], dtype=object)
+        data[f"level{level}"] = names[inverse.ravel()]
+    data["band"] = np.array([f"B{b}" for b in range(fanout)], dtype=object)[rng.integers(0, fanout, size=rows)]
+    data["value"] = rng.integers(0, 1000, size=rows)
+    data["__all__"] = True
+    return pd.DataFrame(data)
+
+def synthetic_spec(depth=3, layouts=layouts, spacing=0.02, styles=("red", "green", "blue", "yellow", "cyan")):
+    # A template_spec for synthetic_hierarchy, cycling through the layouts level by level;
+    # matrix levels lay out each level value across and its band down
+    spec = { "root" : { "partition" : {"template" : "Canvas", "fields" : ["__all__"], "layout" : "fill"},
+                        "style" : styles[0], "label" : "Synthetic Diagram" } }
+    previous = "Canvas"
+    spec[previous] = { "style" : styles[1 % len(styles)], "label" : "Canvas" }
+    for level in range(depth):
+        template = f"Level{level}"
+        layout = layouts[level % len(layouts)]
+        fields = [f"level{level}", "band"] if layout == "matrix" else [f"level{level}"]
+        spec[previous]["partition"] = { "template" : template, "fields" : fields,
+                                        "layout" : layout, "spacing" : spacing }
+        spec[template] = { "style" : styles[(level+2) % len(styles)], "label" : f"%%level{level}%%" }
+        previous = template
+    return spec
+
+def measure(fn, repeat=3, setup=None):
+    # Returns fn's result, its best and mean times, and its peak traced allocation.
+    # setup, if given, is run untimed before every call.
+    setup = setup or (lambda: None)
+    times = []
+    for _ in range(repeat):
+        setup()
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    setup()
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, { "seconds" : min(times), "mean_seconds" : sum(times)/len(times), "peak_bytes" : peak }
+
+def bench(data, specification, styles, w=1600.0, h=1200.0, repeat=3, text_limit=2000):
+    """Times each stage of laying out and rendering data. text_rectangle is
+    measured over at most text_limit panels, as it draws each label with PIL."""
+    stages = {}
+
+    def genchildren():
+        root = Panel(**{'name':'root', 'template':'root', 'query':'(__all__==True)', 'data':data,
+                        'specification':specification, 'style':styles.get(specification['root']['style']),
+                        'x':0.0, 'y':0.0, 'w':w, 'h':h})
+        root.genchildren(specification, styles)
+        return root
+    root, stages["genchildren"] = measure(genchildren, repeat)
+    panels, stages["walk_children"] = measure(lambda: list(root.walk_children()), repeat)
+    _, stages["get_label"] = measure(lambda: [p.get_label() for p in panels], repeat)
+    titled = [(p.get_label(), svgpanels.panel_title(p)[2]) for p in panels[:text_limit]]
+    text = lambda: [svgpanels.text_rectangle(t, r) for t,r in titled]
+    _, stages["text_rectangle"] = measure(text, repeat, cold_fonts)
+    _, stages["text_rectangle_warm"] = measure(text, repeat)
+    svg, stages["svg"] = measure(lambda: _render(root.paint_order(), w, h), repeat, cold_fonts)
+    _, stages["svg_warm"] = measure(lambda: _render(root.paint_order(), w, h), repeat)
+    tree, stages["paneltree_build"] = measure(
+        lambda: PanelTree.build(data, specification, styles, query='(__all__==True)', w=w, h=h), repeat)
+    _, stages["paneltree_svg"] = measure(lambda: _render(tree.paint_order(), w, h), repeat, cold_fonts)
+    return { "panels" : len(panels), "text_panels" : len(titled), "svg_bytes" : len(svg), "stages" : stages }
+
+def cold_fonts():
+    # A fresh font cache, so that fonts are loaded and text measured again
+    svgpanels.font_cache = svgpanels.FontCache(svgpanels.font_cache.maxsize)
+
+def _render(panels, w, h):
+    fp = io.StringIO()
+    svgpanels.write_svg(fp, panels, 0, 0, w, h, w, h)
+    return fp.getvalue()
+
+def run(scales=(1000, 10000, 100000, 1000000), depth=3, fanout=5, skew=1.0, label_length=12,
+        repeat=3, seed=0, styles=None, layouts=layouts):
+    if styles is None:
+        with open(styles_path, "r") as j:
+            styles = json.load(j)
+    specification = synthetic_spec(depth, layouts)
+    params = { "depth" : depth, "fanout" : fanout, "skew" : skew, "label_length" : label_length, "seed" : seed,
+               "layouts" : list(layouts) }
+    results = []
+    for rows in scales:
+        data = synthetic_hierarchy(rows, depth, fanout, skew, label_length, seed)
+        result = bench(data, specification, styles, repeat=repeat)
+        result.update(rows=rows, **params)
+        results.append(result)
+        print(f"{rows:>9} rows {result['panels']:>6} panels " +
+              " ".join(f"{k}={v['seconds']:.4f}s" for k,v in result["stages"].items()), file=sys.stderr)
+    return { "meta" : { "python" : platform.python_version(), "platform" : platform.platform(),
+                        "numpy" : np.__version__, "pandas" : pd.__version__,
+                        "time" : time.strftime("%Y-%m-%dT%H:%M:%S") },
+             "results" : results }
+
+heavy_modules = ("pandas", "networkx", "PIL.Image")
+
+def startup(modules=("graphicalpivots", "svgpanels", "paneltree", "datasources"), repeat=5):
+    """Import time of each module in a fresh interpreter, best of repeat, with the
+    heavy modules it loaded eagerly, and the time for the command line's --help."""
+    code = ("import sys, time; t = time.perf_counter(); import {module}; t = time.perf_counter() - t; "
+            "print(t); print(','.join(h for h in {heavy!r} "
+            "if h in sys.modules and type(sys.modules[h]).__name__ != '_LazyModule'))")
+    directory = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules:
+        times, loaded = [], ""
+        for _ in range(repeat):
+            out = subprocess.run([sys.executable, "-c", code.format(module=module, heavy=heavy_modules)],
+                                 cwd=directory, capture_output=True, text=True, check=True).stdout.split("\n")
+            times.append(float(out[0]))
+            loaded = out[1]
+        results[module] = { "seconds" : min(times), "heavy" : [h for h in loaded.split(",") if h] }
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-m", "graphicalpivots", "--help"], cwd=directory,
+                       capture_output=True, check=True)
+        times.append(time.perf_counter() - start)
+    results["cli_help"] = { "seconds" : min(times), "heavy" : [] }
+    return results
+
+def compare(old, new, threshold=0.1, key="seconds"):
+    # (rows, stage, old, new) for every stage that got more than threshold slower
+    old = {(r["rows"], s):v[key] for r in old["results"] for s,v in r["stages"].items()}
+    regressions = []
+    for r in new["results"]:
+        for s,v in r["stages"].items():
+            before = old.get((r["rows"], s))
+            if before and v[key] > before * (1 + threshold):
+                regressions.append((r["rows"], s, before, v[key]))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks layout and rendering over synthetic hierarchies")
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--fanout", type=int, default=5)
+    parser.add_argument("--skew", type=float, default=1.0)
+    parser.add_argument("--label-length", type=int, default=12)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--layouts", nargs="+", default=list(layouts), choices=layouts,
+                        help="layouts to cycle through, level by level")
+    parser.add_argument("--font", help="TrueType font used to measure text, in place of svgpanels.arial")
+    parser.add_argument("-o", "--output", default="benchmarks.json")
+    parser.add_argument("--compare", help="an earlier results file to check for regressions against")
+    parser.add_argument("--threshold", type=float, default=0.1)
+    parser.add_argument("--startup", action="store_true",
+                        help="only time imports, failing if pandas, networkx or PIL load eagerly")
+    args = parser.parse_args()
+    if args.startup:
+        results = startup(repeat=args.repeat)
+        for module, r in results.items():
+            print(f"{module:<16} {r['seconds']:.4f}s {' '.join(r['heavy'])}", file=sys.stderr)
+        with open(args.output, "w") as j:
+            json.dump({ "startup" : results }, j, indent=1)
+        sys.exit(1 if any(r["heavy"] for r in results.values()) else 0)
+    if args.font:
+        svgpanels.arial = args.font
+    results = run(args.scales, args.depth, args.fanout, args.skew, args.label_length, args.repeat, args.seed,
+                  layouts=args.layouts)
+    with open(args.output, "w") as j:
+        json.dump(results, j, indent=1)
+    if args.compare:
+        with open(args.compare, "r") as j:
+            regressions = compare(json.load(j), results, args.threshold)
+        for rows, stage, before, after in regressions:
+            print(f"{stage} at {rows} rows: {before:.4f}s -> {after:.4f}s", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -1,12 +1,22 @@
 # Blockdef contains core properties for defining a block
+import gc
 import numbers
 #from typing import Literal
 from typing_extensions import Literal
 import pandas as pd
+from instrumentation import count
 
 
 
 class LocatableObject(object):
+    # Attributes are held in slots, one per PanelKwargs entry. The schema is compiled
+    # once per class by _schema into its resolved defaults and a validator per
+    # kwarg, and construction only consults that table. Validation follows the
+    # module's validate flag, and can be switched off per call to from_records
+    # for trusted bulk construction.
+    __slots__ = ("_assigned_kwargs", "id", "margin_left", "margin_right", "margin_top", "margin_bottom",
+                 "layout", "parent", "x", "y", "w", "h", "query", "source")
+
     def __init__(self, **kwargs):
         # These x,y,w,h coordinates operate in a local (0,1) space to the object's parent
         # In the special case of a top-level Panel, these (0,1) coordinates will be scaled
@@ -18,30 +28,75 @@ class LocatableObject(object):
 
         # Different sub-classes of Panel might require additional attributes such as
         # Title, Properties, and Canvas - each of which will be sub-classes of Panel themselves
-        self._assigned_kwargs=set()
-        self._all_kwargs=set(kwargs.keys())
-
+        defaults, validators = _schema(self.__class__)
+        assigned = []
         for k,v in kwargs.items():
-            if k in PanelKwargs.keys():
-                assert _typechecker(v,PanelKwargs[k]["type"])
-                self.__dict__[k]=v
-                self._assigned_kwargs.add(k)
-        unassigned_kwargs_left = self._all_kwargs - self._assigned_kwargs
-        print( "Unassigned:", unassigned_kwargs_left)
+            if k in validators:
+                if validate:
+                    assert validators[k](v)
+                setattr(self, k, v)
+                assigned.append(k)
+            else:
+                count(f"unassigned_kwarg:{k}")
+        self._assigned_kwargs = frozenset(assigned)
 
     def _set_defaults(self):
-        for k,v in PanelKwargs.items():
-            if any([issubclass(self.__class__, c) for c in v['defaults'].keys()]) :
-                d_class = [c for c in v['defaults'].keys() if issubclass(self.__class__, c)][0]
-                #print (self.__class__, v['defaults'])
-                self.__dict__[k]=v['defaults'][d_class]
-                self._assigned_kwargs.add(k)
+        for k,v in _schema(self.__class__)[0].items():
+            setattr(self, k, v)
+        self._assigned_kwargs = frozenset(self._assigned_kwargs | _schema(self.__class__)[0].keys())
 
     def to_dict(self):
-        return {k:self.__dict__[k] for k in self._assigned_kwargs}
+        return {k:getattr(self, k) for k in self._assigned_kwargs}
+
+    @classmethod
+    def from_records(cls, records, validate=False):
+        """Creates one object per record, from a list of dicts or a DataFrame, without
+        calling __init__. Records sharing a set of keys share its bookkeeping, so the
+        only allocation per object is the object itself."""
+        validators = _schema(cls)[1]
+        if isinstance(records, pd.DataFrame):
+            keys = [k for k in records.columns if k in validators]
+            rows = zip(*[records[k].tolist() for k in keys])
+            records = (dict(zip(keys, row)) for row in rows)
+        plans = {}
+        objects = []
+        # The cyclic collector would otherwise rescan the growing list every few thousand objects
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            _fill_records(records, objects, plans, validators, validate, cls)
+        finally:
+            if collecting:
+                gc.enable()
+        return objects
+
+def _fill_records(records, objects, plans, validators, validate, cls):
+    new = object.__new__
+    set_assigned = LocatableObject._assigned_kwargs.__set__
+    for record in records:
+        keys = tuple(record)
+        if keys not in plans:
+            # The slot setters for this set of keys, with None for those left unassigned
+            plans[keys] = (frozenset(k for k in keys if k in validators),
+                           [getattr(LocatableObject, k).__set__ if k in validators else None for k in keys],
+                           [validators.get(k) for k in keys])
+            for k in keys:
+                if k not in validators:
+                    count(f"unassigned_kwarg:{k}")
+        assigned, setters, checks = plans[keys]
+        obj = new(cls)
+        for setter, check, v in zip(setters, checks, record.values()):
+            if setter is not None:
+                if validate:
+                    assert check(v)
+                setter(obj, v)
+        set_assigned(obj, assigned)
+        objects.append(obj)
 
 
 class Panel(LocatableObject):
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(Panel, self).__init__(**kwargs)
 
@@ -51,12 +106,16 @@ class Pane(LocatableObject):
     # titles, key-value pair lists, and descriptive text.
     # x,y,w,h are all strictly expressed in parent terms and will be resolved at render time,
     # after taking into account parent location and margin values
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(Pane, self).__init__(**kwargs)
 
 class RootPanel(Panel):
     # The root panel is a special panel in that it has no parent - probably, it might make sense not
     # to make this special, so maybe refactor later on.
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(RootPanel, self).__init__(**kwargs)
 
@@ -65,6 +124,8 @@ class SubPanel(Panel):
     # Additionally, it acts as a canvas for subsequent drawing items, and can host children within
     # the bounds defined within its margins.
     # All sub-panels have margins
+    __slots__ = ()
+
     def __init__(self, **kwargs):
         super(SubPanel, self).__init__(**kwargs)
 
@@ -128,6 +189,37 @@ PanelKwargs = {
 }
 
 
+# Every schema attribute needs a slot on LocatableObject
+assert set(PanelKwargs) <= set(LocatableObject.__slots__)
+validate = True
+
+_schemas = {}
+
+def _schema(cls):
+    # (defaults, validators) for cls - each kwarg's default from the first class in
+    # its defaults that cls derives from, and a check built from its type
+    if cls not in _schemas:
+        defaults = {}
+        for k,v in PanelKwargs.items():
+            d_classes = [c for c in v['defaults'].keys() if issubclass(cls, c)]
+            if d_classes:
+                defaults[k] = v['defaults'][d_classes[0]]
+        _schemas[cls] = (defaults, {k:_validator(v["type"]) for k,v in PanelKwargs.items()})
+    return _schemas[cls]
+
+def _validator(c):
+    # A one-argument type check, with the type already resolved
+    if isinstance(c,type):
+        if issubclass(c,AbstractParameterLiterals):
+            valid_values = c.valid_values
+            return lambda t: t in valid_values
+        return lambda t: isinstance(t,c)
+    if c is None:
+        return lambda t: t is None
+    c_type = type(c)
+    return lambda t: isinstance(t,c_type)
+
+
 class PanelBuilder(object):
     """The purpose of the PanelBuilder is to accept a specification dictionary,
     and some data source, and use that to generate nested panels.
@@ -139,23 +231,43 @@ class XYPanelBuilder(PanelBuilder):
     pass
 
 class CrosstabPanelBuilder(PanelBuilder):
-    pass
+    """Lays data out as a matrix, with a column for each value of columns and a row
+    for each value of rows. The panel is partitioned on both fields at once with the
+    matrix layout, so every cell's rows come from a single factorization of the
+    frame rather than a query per cell, and only non-empty cells get a panel. A
+    cell may be laid out further by giving a specification whose cell template
+    partitions on; otherwise cells are leaves labelled by their keys."""
+
+    def __init__(self, **kwargs):
+        self.columns = kwargs["columns"]
+        self.rows = kwargs["rows"]
+        self.styles = kwargs["styles"]
+        self.specification = dict(kwargs.get("specification", {}))
+        self.cell = kwargs.get("cell", "cell")
+        self.style = kwargs.get("style", "red")
+        self.cell_style = kwargs.get("cell_style", self.style)
+        self.label = kwargs.get("label", f"{self.rows} by {self.columns}")
+        self.spacing = kwargs.get("spacing")
+
+    def template_spec(self):
+        spec = dict(self.specification)
+        partition = {"template" : self.cell, "fields" : [self.columns, self.rows], "layout" : "matrix"}
+        if self.spacing is not None:
+            partition["spacing"] = self.spacing
+        spec["crosstab"] = {"partition" : partition, "style" : self.style, "label" : self.label}
+        spec.setdefault(self.cell, {"style" : self.cell_style,
+                                    "label" : f"%%{self.rows}%% / %%{self.columns}%%"})
+        return spec
+
+    def crosstab(self, data):
+        # Row counts of every cell, rows down and columns across, in one groupby pass.
+        # Missing values are kept as keys, as the matrix partition keeps them.
+        return data.groupby([self.rows, self.columns], dropna=False).size().unstack(fill_value=0)
+
+    def build(self, data, x=0.0, y=0.0, w=1.0, h=1.0, query=None, **kwargs):
+        # The laid-out matrix as a paneltree.PanelTree; kwargs are passed to PanelTree.build
+        from paneltree import PanelTree
+        return PanelTree.build(data, self.template_spec(), self.styles, "crosstab", query, x, y, w, h, **kwargs)
 
 class GridPanelBuilder(PanelBuilder):
     pass
-
-
-
-
-def _typechecker(t,c):
-    if isinstance(c,type):
-        if issubclass(c,AbstractParameterLiterals):
-            return t in c.valid_values
-        else :
-            return isinstance(t,c)
-    else:
-        if c is None:
-            return t is None
-        else:
-            c_type = type(c)
-            return isinstance(t,c_type)
@@ -0,0 +1,222 @@
+import numpy as np
+from graphicalpivots import PartitionEngine, partition_name, label_template
+from instrumentation import phase, count
+from lazyimport import lazy_import
+
+pd = lazy_import("pandas")
+
+# Data sources are what the PanelTree builder partitions data through. A source
+# hands out opaque selections - one per panel - and splits a whole level of them
+# at once, so that a backend such as a database can answer each template level
+# with a single query. Each partition of a selection is returned as
+#
+#     (name, key, selection, count, row, values)
+#
+# where row identifies the partition's last row and values holds that row's
+# values for the requested label fields, as Panel.get_label would read them.
+
+
+class DataSource(object):
+    columns = ()
+
+    def root(self, query=None):
+        raise NotImplementedError
+
+    def describe(self, selection, label_fields):
+        # (count, row, values) for a single selection
+        raise NotImplementedError
+
+    def partition_level(self, selections, fields, label_fields):
+        # For each of selections, its partitions by fields in partition_scheme order
+        raise NotImplementedError
+
+
+class DataFrameSource(DataSource):
+    """The default source, over an in-memory pandas DataFrame. Selections are
+    arrays of row positions, split with a shared PartitionEngine."""
+
+    def __init__(self, data, engine=None):
+        self.data = data
+        self.engine = PartitionEngine(data) if engine is None else engine
+
+    @property
+    def columns(self):
+        return list(self.data.columns)
+
+    def root(self, query=None):
+        if query is None:
+            return np.arange(len(self.data))
+        count("queries")
+        count("rows_scanned", len(self.data))
+        with phase("query"):
+            return np.flatnonzero(np.asarray(self.data.eval(query), dtype=bool))
+
+    def rows_values(self, rows, fields):
+        # Values of fields for many rows at once, reading each column in one pass
+        with phase("labels"):
+            columns = [self.data[f].iloc[rows].tolist() for f in fields]
+        return [dict(zip(fields, values)) for values in zip(*columns)] if fields else [{}] * len(rows)
+
+    def describe(self, rows, label_fields):
+        row = int(rows[-1]) if len(rows) else -1
+        return len(rows), row, (self.rows_values([row], label_fields)[0] if row >= 0 else {})
+
+    def partition_level(self, selections, fields, label_fields):
+        splits = [self.engine.split(rows, fields) for rows in selections]
+        last_rows = [int(index[-1]) for split in splits for name, key, index in split]
+        values = iter(self.rows_values(last_rows, label_fields))
+        return [[(name, key, index, len(index), int(index[-1]), next(values)) for name, key, index in split]
+                for split in splits]
+
+
+class AggregateSource(DataFrameSource):
+    """A DataFrameSource over pre-aggregated data, with one row per distinct
+    combination of every partition field, its __count__ of source rows, and the
+    label fields of the last of those rows, numbered by __row__. Built by
+    aggregate_csv, so that trees can be laid out from inputs too large to load."""
+
+    def __init__(self, aggregate, engine=None):
+        super(AggregateSource, self).__init__(aggregate, engine)
+        self.counts = aggregate["__count__"].to_numpy()
+        self.last = aggregate["__row__"].to_numpy()
+
+    def describe(self, rows, label_fields):
+        if len(rows) == 0:
+            return 0, -1, {}
+        last = rows[np.argmax(self.last[rows])]
+        return int(self.counts[rows].sum()), int(self.last[last]), self.rows_values([int(last)], label_fields)[0]
+
+    def partition_level(self, selections, fields, label_fields):
+        splits = [self.engine.split(rows, fields) for rows in selections]
+        lasts = [index[np.argmax(self.last[index])] for split in splits for name, key, index in split]
+        values = iter(self.rows_values(lasts, label_fields))
+        return [[(name, key, index, int(self.counts[index].sum()), int(self.last[index].max()), next(values))
+                 for name, key, index in split]
+                for split in splits]
+
+
+def spec_fields(specification):
+    # The partition fields and the label fields used anywhere in a template specification
+    partition_fields, label_fields = [], []
+    for t in specification.values():
+        for f in t.get('partition', {}).get('fields', []):
+            if f not in partition_fields:
+                partition_fields.append(f)
+        for f in label_template(t.get('label', "")).fields:
+            if f not in label_fields:
+                label_fields.append(f)
+    return partition_fields, label_fields
+
+def aggregate_chunks(chunks, specification, query=None):
+    """Folds an iterable of DataFrame chunks into the aggregate an AggregateSource
+    is built on. Only the aggregate so far and one chunk are held at a time, so
+    memory scales with the number of distinct partitions rather than of rows."""
+    fields, label_fields = spec_fields(specification)
+    columns = fields + [f for f in label_fields if f not in fields]
+    aggregate, offset = None, 0
+    for chunk in chunks:
+        count("rows_scanned", len(chunk))
+        rows = np.arange(offset, offset + len(chunk))
+        offset += len(chunk)
+        if query is not None:
+            mask = np.asarray(chunk.eval(query), dtype=bool)
+            chunk, rows = chunk[mask], rows[mask]
+        chunk = chunk[columns].assign(__row__=rows, __count__=1)
+        aggregate = chunk if aggregate is None else pd.concat([aggregate, chunk], ignore_index=True)
+        counts = aggregate.groupby(fields, dropna=False, sort=False)["__count__"].transform("sum")
+        aggregate = aggregate.assign(__count__=counts).sort_values("__row__", kind="stable")
+        aggregate = aggregate.drop_duplicates(fields, keep="last").reset_index(drop=True)
+    if aggregate is None:
+        aggregate = pd.DataFrame(columns=columns + ["__row__", "__count__"])
+    return aggregate
+
+def aggregate_csv(path, specification, chunksize=100000, query=None, **kwargs):
+    # Reads a CSV in chunks into an AggregateSource; a query is applied to each chunk,
+    # so without one only the columns the specification uses are read at all
+    if query is None and "usecols" not in kwargs:
+        fields, label_fields = spec_fields(specification)
+        kwargs["usecols"] = lambda c: c in fields or c in label_fields
+    with pd.read_csv(path, chunksize=chunksize, **kwargs) as chunks:
+        return AggregateSource(aggregate_chunks(chunks, specification, query))
+
+
+class SQLiteSource(DataSource):
+    """Partitions a SQLite table, or the result of a SELECT statement, inside the
+    database. Each template level is answered by one GROUP BY query over the
+    fields of that level and of every level above it, which also returns the
+    partition counts and, through SQLite's bare-column rule for MAX(), the label
+    fields of each partition's last row. Selections are (where, conditions)
+    pairs, where the root query is a SQL expression."""
+
+    # Levels expanding fewer selections than this filter on their keys, so that
+    # lazily expanding a few panels can use the database's indexes
+    filter_limit = 200
+
+    def __init__(self, connection, table=None, sql=None):
+        if (table is None) == (sql is None):
+            raise ValueError("SQLiteSource needs exactly one of table or sql")
+        self.connection = connection
+        if table is not None:
+            self.source = f"(SELECT rowid AS __row__, * FROM {quote(table)})"
+        else:
+            self.source = f"(SELECT ROW_NUMBER() OVER () AS __row__, * FROM ({sql}))"
+        cursor = connection.execute(f"SELECT * FROM {self.source} LIMIT 0")
+        self._columns = [c[0] for c in cursor.description if c[0] != "__row__"]
+        self.queries = 0
+
+    @property
+    def columns(self):
+        return list(self._columns)
+
+    def execute(self, sql, params=()):
+        self.queries += 1
+        count("queries")
+        with phase("sql"):
+            return self.connection.execute(sql, params).fetchall()
+
+    def root(self, query=None):
+        return (query, ())
+
+    def _where(self, where, clauses=(), params=()):
+        clauses = ([f"({where})"] if where else []) + list(clauses)
+        return (" WHERE " + " AND ".join(clauses)) if clauses else "", list(params)
+
+    def describe(self, selection, label_fields):
+        where, conditions = selection
+        clause, params = self._where(where, [f"{quote(f)} IS ?" for f,v in conditions], [v for f,v in conditions])
+        columns = "".join(f", {quote(f)}" for f in label_fields)
+        count, row, *values = self.execute(f"SELECT COUNT(*), MAX(__row__){columns} FROM {self.source}{clause}", params)[0]
+        return count, (-1 if row is None else row), dict(zip(label_fields, values))
+
+    def partition_level(self, selections, fields, label_fields):
+        results = {}
+        # Selections on one level share their root query and conditioned fields
+        for where, outer in {(s[0], tuple(f for f,v in s[1])) for s in selections}:
+            wanted = [s for s in selections if s[0] == where and tuple(f for f,v in s[1]) == outer]
+            clauses, params = [], []
+            if outer and len(wanted) < self.filter_limit:
+                clauses.append("(" + " OR ".join(
+                    "(" + " AND ".join(f"{quote(f)} IS ?" for f in outer) + ")" for s in wanted) + ")")
+                params = [v for s in wanted for f,v in s[1]]
+            clause, params = self._where(where, clauses, params)
+            group = ", ".join(quote(f) for f in list(outer) + list(fields))
+            columns = "".join(f", {quote(f)}" for f in label_fields)
+            sql = (f"SELECT {group}, COUNT(*), MAX(__row__){columns} FROM {self.source}{clause} "
+                   f"GROUP BY {group}")
+            for r in self.execute(sql, params):
+                parent = r[:len(outer)]
+                key = tuple(r[len(outer):len(outer)+len(fields)])
+                count, row = r[len(outer)+len(fields):len(outer)+len(fields)+2]
+                values = dict(zip(label_fields, r[len(outer)+len(fields)+2:]))
+                selection = (where, tuple(zip(outer, parent)) + tuple(zip(fields, key)))
+                results.setdefault((where, tuple(zip(outer, parent))), []).append(
+                    (partition_name(fields, key), key, selection, count, row, values))
+        return [sorted(results.get(s, []), key=lambda p: p[0]) for s in selections]
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
+
+def as_source(data):
+    # Lets the builders accept a DataFrame wherever they accept a DataSource
+    return data if isinstance(data, DataSource) else DataFrameSource(data)
@@ -1,11 +1,23 @@
-import networkx as nx
-import pandas as pd
+import numpy as np
 from math import sqrt, ceil
 import re
+import sys
+from instrumentation import phase, count, count_depth
+from lazyimport import lazy_import, resolve
+
+# pandas is only loaded once data is partitioned, and networkx by calculate_graph
+pd = lazy_import("pandas")
+
+def partition_name(fields, key):
+    # Panel names keep the stringified-dict form, and sibling order follows it
+    return str(dict(zip(fields, key)))
 
 def partition_scheme(data, query, fields):
-    #print(query, fields)
-    return sorted(list(set([str(dict(r.items())) for i,r in data.query(query)[fields].iterrows()])))
+    count("queries")
+    count("rows_scanned", len(data))
+    with phase("query"):
+        keys = data.query(query)[fields].drop_duplicates().itertuples(index=False, name=None)
+    return sorted([partition_name(fields, k) for k in keys])
 
 def qwrap(v):
     if isinstance(v, str):
@@ -14,12 +26,102 @@ def qwrap(v):
         return v
 
 def process_template_string(t_string, data):
-    dpc_rx=re.compile("(%%(.*?)%%)+")
-    qstring=t_string
-
-    for m in dpc_rx.findall(t_string):
-        qstring=qstring.replace(m[0], str(data[m[1]]))
-    return qstring
+    return label_template(t_string).format(data)
+
+
+class LabelTemplate(object):
+    """A label template such as "Layer %%layer%%", split once into its literal
+    text and the fields substituted between it."""
+    field_rx = re.compile("%%(.*?)%%")
+
+    def __init__(self, t_string):
+        self.template = t_string
+        parts = self.field_rx.split(t_string)
+        self.literals = parts[0::2]
+        self.fields = parts[1::2]
+
+    def format(self, data):
+        if not self.fields:
+            return self.template
+        label = [self.literals[0]]
+        for f,l in zip(self.fields, self.literals[1:]):
+            label.append(str(data[f]))
+            label.append(l)
+        return "".join(label)
+
+    def format_rows(self, data, rows):
+        # Labels for many rows of data at once, reading each field's column in one pass.
+        # A negative row, as for a panel with no rows, leaves the template unfilled.
+        rows = np.asarray(rows, dtype=np.int64)
+        if not self.fields:
+            return [self.template] * len(rows)
+        found = rows >= 0
+        columns = [[str(v) for v in data[f].iloc[rows[found]].tolist()] for f in self.fields]
+        labels = [self.template] * len(rows)
+        for e, values in zip(np.flatnonzero(found).tolist(), zip(*columns)):
+            label = [self.literals[0]]
+            for v,l in zip(values, self.literals[1:]):
+                label.append(v)
+                label.append(l)
+            labels[e] = "".join(label)
+        return labels
+
+_label_templates = {}
+
+def label_template(t_string):
+    # Compiled templates are shared, as a specification reuses the same few strings
+    if t_string not in _label_templates:
+        _label_templates[t_string] = LabelTemplate(t_string)
+    return _label_templates[t_string]
+
+
+class PartitionEngine(object):
+    """Factorizes each set of partition fields once over the whole frame, so
+    that every panel on a template level can be split into its child partitions
+    from its row positions alone, without building or running a query."""
+
+    def __init__(self, data):
+        self.data = data
+        self._factorized = {}
+
+    def factorize(self, fields):
+        fields = tuple(fields)
+        if fields in self._factorized:
+            return self._factorized[fields]
+        count("rows_scanned", len(self.data))
+        with phase("factorize"):
+            codes, uniques = zip(*[pd.factorize(self.data[f], use_na_sentinel=False) for f in fields])
+            uniques = [u.tolist() for u in uniques]
+            if len(fields) == 1:
+                group_codes = codes[0]
+                keys = [(u,) for u in uniques[0]]
+            else:
+                combined, group_codes = np.unique(np.column_stack(codes), axis=0, return_inverse=True)
+                keys = [tuple(uniques[e][c] for e,c in enumerate(row)) for row in combined.tolist()]
+            self._factorized[fields] = (np.asarray(group_codes).ravel(), keys)
+        return self._factorized[fields]
+
+    def split(self, positions, fields):
+        """Returns (name, key, positions) for each distinct key among the rows
+        at positions, ordered by name as partition_scheme orders them."""
+        if len(positions) == 0:
+            return []
+        codes, keys = self.factorize(fields)
+        count("rows_scanned", len(positions))
+        with phase("partition"):
+            return self._split(codes, keys, positions, fields)
+
+    def _split(self, codes, keys, positions, fields):
+        sub = codes[positions]
+        order = np.argsort(sub, kind="stable")
+        ordered = sub[order]
+        bounds = np.flatnonzero(np.diff(ordered)) + 1
+        starts, ends = np.r_[0, bounds], np.r_[bounds, len(ordered)]
+        groups = []
+        for s,e in zip(starts, ends):
+            key = keys[ordered[s]]
+            groups.append((partition_name(fields, key), key, positions[order[s:e]]))
+        return sorted(groups, key=lambda g: g[0])
 
 
 class AbstractParameterLiterals(object):
@@ -49,9 +151,9 @@ class KwargClass(object):
                 self._assigned_kwargs.add(k)
         unassigned_kwargs_left = self._all_kwargs - self._assigned_kwargs
         if len (unassigned_kwargs_left)>0:
-            print( "Unassigned:", unassigned_kwargs_left)
             # Just assign them? No type checking this way
             for k in unassigned_kwargs_left:
+                count(f"unassigned_kwarg:{k}")
                 self.__dict__[k]=kwargs[k]
 
     def _set_defaults(self):
@@ -66,9 +168,11 @@ class KwargClass(object):
 
     @staticmethod
     def _typechecker(t,c):
+        # Types given by dotted path are resolved, and so imported, only when checked
+        if isinstance(c,str) and "." in c:
+            c = resolve(c)
         if isinstance(c,type):
             if issubclass(c,AbstractParameterLiterals):
-                print (c.valid_values)
                 return t in c.valid_values
             else :
                 return isinstance(t,c)
@@ -77,7 +181,6 @@ class KwargClass(object):
                 return t is None
             else:
                 c_type = type(c)
-                print(c_type)
                 return isinstance(t,c_type)
 
 class LayoutMethod(KwargClass):
@@ -167,20 +270,204 @@ class LayoutMethod(KwargClass):
 
     @staticmethod
     def MatrixLayout(i,j,m,n,spacing=None,p=None):
-        x,w,_=LayoutMethod.layout_matrix_partition(i,j,m,n,spacing,p)
-        y,h=0,1
-        return (x,y,w,h)
+        return LayoutMethod.layout_matrix_partition(i,j,m,n,spacing,p)
+
+    # Batch variants return all n (x,y,w,h) boxes of a layout as one (n,4) array in O(n),
+    # matching the per-index methods above value for value. They are attached to the
+    # per-index methods below, e.g. LayoutMethod.ColumnLayout.batch(n, spacing, p).
+
+    @staticmethod
+    def linear_partition_batch(n, spacing=None, p=None):
+        sp = 1/n if spacing is None else spacing
+        p = np.ones(n) if p is None else np.asarray(p[:n], dtype=float)
+        # Interleave (0, p0, sp, p1, sp, ...) and accumulate in the same order as
+        # layout_linear_partition, so that the boundaries come out identical.
+        steps = np.full(2*n, sp, dtype=float)
+        steps[0] = 0
+        steps[1::2] = p
+        b_range = np.cumsum(steps) / np.cumsum(steps)[-1]
+        return b_range[0::2], b_range[1::2]-b_range[0::2]
+
+    @staticmethod
+    def column_batch(n, spacing=None, p=None):
+        boxes = np.zeros((n,4))
+        if n:
+            boxes[:,0], boxes[:,2] = LayoutMethod.linear_partition_batch(n, spacing, p)
+            boxes[:,3] = 1
+        return boxes
+
+    @staticmethod
+    def row_batch(n, spacing=None, p=None):
+        boxes = np.zeros((n,4))
+        if n:
+            boxes[:,1], boxes[:,3] = LayoutMethod.linear_partition_batch(n, spacing, p)
+            boxes[:,2] = 1
+        return boxes
+
+    @staticmethod
+    def fill_batch(n, spacing=None, p=None):
+        return np.tile([0.0,0.0,1.0,1.0], (n,1))
+
+    @staticmethod
+    def block_batch(n, spacing=None, p=None, ar=None):
+        if ar is None:
+            ar=1
+        if p is None:
+            p = [1 for x in range(0,n)]
+        boxes = np.zeros((n,4))
+        if n:
+            cols=ceil((sqrt(n))*ar)
+            rows=ceil(LayoutMethod.safe_div(n,cols))
+            i = np.arange(n)
+            x, w = LayoutMethod.linear_partition_batch(rows, spacing, p)
+            y, h = LayoutMethod.linear_partition_batch(cols, spacing, p)
+            boxes[:,0], boxes[:,2] = x[i//cols], w[i//cols]
+            boxes[:,1], boxes[:,3] = y[i%cols], h[i%cols]
+        return boxes
+
+    @staticmethod
+    def matrix_batch(m, n, spacing=None, p=None):
+        # Boxes for every (i,j) cell of an m x n matrix, in row-major order of i
+        boxes = np.zeros((m*n,4))
+        if m and n:
+            x, w = LayoutMethod.linear_partition_batch(m, spacing, p)
+            y, h = LayoutMethod.linear_partition_batch(n, spacing, p)
+            boxes[:,0], boxes[:,2] = np.repeat(x, n), np.repeat(w, n)
+            boxes[:,1], boxes[:,3] = np.tile(y, m), np.tile(h, m)
+        return boxes
+
+LayoutMethod.ColumnLayout.batch = LayoutMethod.column_batch
+LayoutMethod.RowLayout.batch = LayoutMethod.row_batch
+LayoutMethod.FillLayout.batch = LayoutMethod.fill_batch
+LayoutMethod.BlockLayout.batch = LayoutMethod.block_batch
+LayoutMethod.MatrixLayout.batch = LayoutMethod.matrix_batch
+
+
+def resolve_positions(parent, style, local_boxes):
+    # Vectorized Panel.resolve_position_on_canvas, for an (n,4) array of local boxes
+    px,py,pw,ph = parent
+    cx,cy,cw,ch = (px + (pw * style['margin_left']) + style['canvas']['x'],
+                  py + (ph * style['margin_top']) + style['canvas']['y'],
+                  (pw - (pw * (style['margin_left'] + style['margin_right'])) ) * style['canvas']['w'],
+                  (ph - (ph * (style['margin_top'] + style['margin_bottom']))) * style['canvas']['h'])
+    local_boxes = np.asarray(local_boxes, dtype=float).reshape(-1,4)
+    return np.column_stack([cx + (cw*local_boxes[:,0]),
+                            cy + (ch*local_boxes[:,1]),
+                            cw * local_boxes[:,2],
+                            ch * local_boxes[:,3]])
+
+
+class TemplatePlan(object):
+    """A single template of a compiled specification, with its successors,
+    style dict, partition fields and layout callable already resolved."""
+    __slots__ = ("name", "successors", "style_name", "style", "label", "label_template", "fields", "layout", "spacing")
+
+    def __init__(self, name, successors, style_name, style, label, fields, layout, spacing):
+        self.name = name
+        self.successors = successors
+        self.style_name = style_name
+        self.style = style
+        self.label = label
+        self.label_template = label_template(label)
+        self.fields = fields
+        self.layout = layout
+        self.spacing = spacing
+
+    def local_positions(self, n):
+        # Templates with no layout keep the historical fallback position
+        if self.layout is None:
+            return np.tile([0.1,0.1,1.0,1.0], (n,1))
+        return self.layout.batch(n, self.spacing)
+
+    @property
+    def matrix(self):
+        return self.layout is LayoutMethod.MatrixLayout
+
+    def positions(self, keys):
+        # Boxes for the partitions with keys. A matrix lays out the full grid of the
+        # distinct values of its first field across and its second down, and keeps the
+        # cells that have a partition; other layouts only need the partition count.
+        if not self.matrix:
+            return self.local_positions(len(keys))
+        across = sorted({k[0] for k in keys}, key=lambda v: partition_name(self.fields[:1], (v,)))
+        down = sorted({k[1] for k in keys}, key=lambda v: partition_name(self.fields[1:], (v,)))
+        i, j = {v:e for e,v in enumerate(across)}, {v:e for e,v in enumerate(down)}
+        grid = self.layout.batch(len(across), len(down), self.spacing)
+        return grid[np.array([i[k[0]]*len(down) + j[k[1]] for k in keys], dtype=np.int64)]
+
+    def __repr__(self):
+        return str((self.name, self.successors, self.fields, self.spacing))
+
+
+class LayoutPlan(object):
+    """A template specification and styles compiled by compile_spec. The plan
+    holds no data, so one plan can be reused across many data refreshes."""
+
+    def __init__(self, templates, specification, styles):
+        self.templates = templates
+        self.specification = specification
+        self.styles = styles
+
+    def __getitem__(self, template):
+        return self.templates[template]
+
+    def __contains__(self, template):
+        return template in self.templates
+
+
+def compile_spec(template_spec, styles):
+    templates = {}
+    for k,obj in template_spec.items():
+        if obj.get('style') not in styles:
+            raise ValueError(f"Template {k!r} refers to unknown style {obj.get('style')!r}")
+        partition = obj.get('partition', {})
+        successors = ()
+        fields = None
+        layout = None
+        if 'template' in partition.keys():
+            successors = (partition['template'],)
+            if partition['template'] not in template_spec:
+                raise ValueError(f"Template {k!r} partitions into unknown template {partition['template']!r}")
+            if 'fields' not in partition:
+                raise ValueError(f"Template {k!r} has a partition with no fields")
+            fields = list(partition['fields'])
+            if 'layout' in partition:
+                layout = LayoutMethod(partition['layout']).method
+                if layout is None:
+                    raise ValueError(f"Template {k!r} has unknown layout {partition['layout']!r}")
+                if layout is LayoutMethod.MatrixLayout and len(fields) != 2:
+                    raise ValueError(f"Template {k!r} has a matrix layout, which needs two fields, across and down")
+        templates[k] = TemplatePlan(k, successors, obj['style'], styles[obj['style']], obj.get('label', "Untitled"),
+                                    fields, layout, partition.get('spacing'))
+
+    # Each template has at most one successor, so following the chain from every
+    # template is enough to reject cycles, which would otherwise recurse forever.
+    for k in templates:
+        seen = set()
+        while k is not None:
+            if k in seen:
+                raise ValueError(f"Template specification contains a cycle through {k!r}")
+            seen.add(k)
+            k = templates[k].successors[0] if templates[k].successors else None
+
+    return LayoutPlan(templates, template_spec, styles)
 
 
 class Panel(KwargClass):
-    defaults = { "x" : 0.0, "y" : 0.0, "w" : 1.0, "h" : 1.0, "local_pos" : (0.0,0.0,1.0,1.0)}
+    defaults = { "x" : 0.0, "y" : 0.0, "w" : 1.0, "h" : 1.0, "local_pos" : (0.0,0.0,1.0,1.0),
+                 "index" : None, "engine" : None, "label" : None, "depth" : 0}
     kwargspec = { "name" : { "type" : str },
                   "template" : { "type" : str },
-                  "data" : { "type" : pd.DataFrame },
+                  "data" : { "type" : "pandas.DataFrame" },
                   "specification" : { "type" : dict },
                   "style" : { "type" : dict },
                   "parent" : { "type" : str },
                   "query" : { "type" : str },
+                  "index" : { "type" : np.ndarray },
+                  "engine" : { "type" : PartitionEngine },
+                  "local_pos" : { "type" : tuple },
+                  "label" : { "type" : str },
+                  "depth" : { "type" : int },
                   "x" : { "type" : (float,int) },
                   "y" : { "type" : (float,int) },
                   "w" : { "type" : (float,int) },
@@ -193,18 +480,29 @@ class Panel(KwargClass):
         #self.style = self.specification.get(self.template,{}).get('style')
         self._set_defaults()
 
+    def rows(self):
+        # Row positions of this panel within data - only the root resolves its query,
+        # every other panel is handed its positions by its parent's partition.
+        if self.index is None:
+            count("queries")
+            count("rows_scanned", len(self.data))
+            with phase("query"):
+                self.index = np.flatnonzero(np.asarray(self.data.eval(self.query), dtype=bool))
+        return self.index
+
     def get_label(self):
-        data_pool = self.data.query(self.query)
-        data_pool = [{k:v for i,r in data_pool.iterrows() for k,v in r.items()}]
-        if len(data_pool)==0:
-            data_pool = [{}]
-        label = process_template_string(self.specification[self.template].get("label", "Untitled"), dict(data_pool[0]))
-        return label
+        # Labels are filled in by the parent's genchildren a level at a time; only the
+        # root fills its own, from the last of its rows as with every other panel.
+        if self.label is None:
+            template = label_template(self.specification[self.template].get("label", "Untitled"))
+            self.label = template.format_rows(self.data, self.rows()[-1:])[0] if len(self.rows()) else template.template
+        return self.label
 
     def __repr__(self):
         return str((self.name, self.template, len(self.children), self.x, self.y))
 
     def calculate_graph(self):
+        import networkx as nx
         dg=nx.DiGraph()
         spec=self.specification
         for k in spec.keys():
@@ -217,10 +515,15 @@ class Panel(KwargClass):
         return dg
 
     def partition(self):
-        if 'partition' in self.specification[self.template].keys():
-            return partition_scheme(self.data,
-                                      self.query,
-                                      self.specification[self.template]['partition']['fields'])
+        return [name for name, key, index in self.partition_groups()]
+
+    def partition_groups(self, fields=None):
+        if fields is None and 'partition' in self.specification[self.template].keys():
+            fields = self.specification[self.template]['partition']['fields']
+        if fields is not None:
+            if self.engine is None:
+                self.engine = PartitionEngine(self.data)
+            return self.engine.split(self.rows(), fields)
         else:
             return []
 
@@ -241,62 +544,56 @@ class Panel(KwargClass):
 
 
 
-    def genchildren(self, specification, styles):
+    def genchildren(self, specification, styles, plan=None):
+        # A plan compiled once with compile_spec may be passed in, and is reused by every
+        # panel in the tree, so the specification is only walked and validated once.
+        if plan is None:
+            plan = compile_spec(specification, styles)
         children=[]
-        graph = self.calculate_graph()
-        for s in graph.successors(self.template):
-            child_spec=specification[s]
-            partition = self.partition()
-            n = len(partition)
-            for i,p in enumerate(partition):
-#                print(p)
-                #local_pos = self.specification[self.template]['partition']['layout']
-                try: # In case there are no partition details - default local_pos to (0,0,1,1)
-#                    print("`", child_spec['partition']['layout'], "`")
-                    #layout_m = LayoutMethod(child_spec['partition']['layout'])
-                    layout_m = LayoutMethod(specification[self.template]['partition']['layout'])
-                    spacing = specification[self.template]['partition'].get('spacing')
-#                    print(i,n, layout_m.method(i,n))
-                    if spacing is None:
-                        local_pos = layout_m.method(i,n)
-                    else:
-                        local_pos = layout_m.method(i,n, spacing=spacing)
-                    # Get the name of the style, this is either resolvable to
-                    # a set of styles directly, or might be a reference to a field
-                    # in the data, that would reference a style at an individual level.
-
-
-                except KeyError as e:
-                    print("!")
-                    print(s, self.name)
-                    local_pos = (0.1,0.1,1,1)
-
-                child_style = styles.get(child_spec['style'])
-
-                x,y,w,h = self.resolve_position_on_canvas(local_pos)
-
+        t_plan = plan[self.template]
+        if self.depth == 0:
+            count_depth(0)
+        if t_plan.successors:
+            partition = self.partition_groups(t_plan.fields)
+        else:
+            partition = []
+        n = len(partition)
+        with phase("layout"):
+            boxes = t_plan.positions([key for p,key,index in partition])
+            canvas = resolve_positions((self.x, self.y, self.w, self.h), self.style, boxes).tolist()
+            boxes = boxes.tolist()
+        last_rows = [index[-1] for p,key,index in partition]
+        for s in t_plan.successors:
+            child_style = plan[s].style
+            with phase("labels"):
+                labels = plan[s].label_template.format_rows(self.data, last_rows)
+            count_depth(self.depth+1, n)
+            for i,(p,key,index) in enumerate(partition):
+                local_pos = tuple(boxes[i])
+                x,y,w,h = canvas[i]
+
+                # The query is kept for debugging only, rows are selected by index
                 c_query = " and ".join([self.query,
-                        " and ".join([f"({k}=={qwrap(v)})" for k,v in eval(p).items()])])
-
-                c_label = self.data.query(c_query)
-
-
-
+                        " and ".join([f"({k}=={qwrap(v)})" for k,v in zip(t_plan.fields, key)])])
 
                 child = Panel(**{"name":p,
                                "template":s,
                                "parent":self.name,
                                "query":c_query,
+                               "index":index,
+                               "engine":self.engine,
                                "data":self.data,
                                "specification":specification,
                                "local_pos":local_pos,
+                               "label" : labels[i],
+                               "depth" : self.depth+1,
                                "style" : child_style,
                                "x" : x,
                                "y" : y,
                                "w" : w,
                                "h" : h})
 
-                child.genchildren(specification, styles)
+                child.genchildren(specification, styles, plan)
                 children.append(child)
 
         self.children=children
@@ -309,3 +606,78 @@ class Panel(KwargClass):
             for w in wc:
                 yield w
         yield self
+
+    def paint_order(self):
+        # The same order as reversing walk_children - each panel before its children,
+        # later siblings first - but iterative, and without materializing the tree.
+        stack = [self]
+        while stack:
+            panel = stack.pop()
+            yield panel
+            stack.extend(getattr(panel, "children", []))
+
+
+def main(argv=None):
+    """python -m graphicalpivots spec.json data.csv -o out.svg
+
+    Lays out a CSV with a JSON template specification and renders it, as SVG,
+    compressed .svgz or .png by the output's extension. Only what the chosen
+    output needs is imported."""
+    import argparse
+    import json
+    import os
+    parser = argparse.ArgumentParser(prog="python -m graphicalpivots",
+                                     description="Renders a diagram of a CSV from a JSON template specification")
+    parser.add_argument("spec", help="JSON template specification")
+    parser.add_argument("data", help="CSV data")
+    parser.add_argument("-o", "--output", required=True, help="output .svg, .svgz or .png, or - for SVG on stdout")
+    parser.add_argument("--styles", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "styles.json"))
+    parser.add_argument("--template", default="root")
+    parser.add_argument("--query", help="root query, in DataFrame.eval syntax")
+    parser.add_argument("--width", type=float, default=1600.0)
+    parser.add_argument("--height", type=float, default=1200.0)
+    parser.add_argument("--compact", action="store_true", help="write compact SVG")
+    parser.add_argument("--font", help="TrueType font used to measure text")
+    parser.add_argument("--exact-text", action="store_true",
+                        help="fit each title with PIL, as write_svg does, rather than all at once from glyph tables")
+    args = parser.parse_args(argv)
+
+    from paneltree import PanelTree
+    import svgpanels
+    if args.font:
+        svgpanels.arial = args.font
+    with open(args.spec, "r") as j:
+        specification = json.load(j)
+    with open(args.styles, "r") as j:
+        styles = json.load(j)
+    if args.template not in specification:
+        parser.error(f"the specification has no template {args.template!r}")
+    try:
+        tree = PanelTree.build(pd.read_csv(args.data), specification, styles, args.template, args.query,
+                               0.0, 0.0, args.width, args.height)
+    except ValueError as e:
+        parser.error(str(e))
+    window = (0, 0, args.width, args.height, args.width, args.height)
+    output = args.output
+    compact = svgpanels.CompactSVG(styles) if args.compact else False
+    fitted = not args.exact_text
+    if output.endswith(".png"):
+        import rasterpanels
+        rasterpanels.write_png(output, tree.paint_order(), *window)
+    elif output.endswith(".svgz"):
+        svgpanels.write_svgz(output, tree.paint_order(), *window, compact=compact, fitted=fitted)
+    else:
+        if compact:
+            write = lambda fp: svgpanels.write_compact_svg(fp, tree.paint_order(), *window, compact=compact,
+                                                           fitted=fitted)
+        else:
+            write = lambda fp: svgpanels.write_svg(fp, tree.paint_order(), *window, fitted=fitted)
+        if output == "-":
+            write(sys.stdout)
+        else:
+            with open(output, "w", encoding="utf-8") as fp:
+                write(fp)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
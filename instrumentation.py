@@ -0,0 +1,119 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Opt-in timers and counters for the hot paths of building and rendering trees.
+# Instrumented code calls phase() and count(); while no Stats is collecting they
+# return at once, so the cost when disabled is one global lookup per call.
+#
+#     with instrumentation.collect(trace=True) as stats:
+#         tree = PanelTree.build(data, template_spec, styles)
+#     print(stats)
+#     stats.write_trace("build.json")   # open in chrome://tracing or Perfetto
+
+stats = None
+
+
+class Stats(object):
+    """Per-phase times (seconds and calls), named counters, panels created per
+    depth, and if trace is set, a complete event per timed phase in the Chrome
+    trace event format."""
+
+    def __init__(self, trace=False):
+        self.timers = {}
+        self.counters = {}
+        self.depths = {}
+        self.events = [] if trace else None
+        self.start = time.perf_counter()
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def count_depth(self, depth, n=1):
+        self.depths[depth] = self.depths.get(depth, 0) + n
+
+    def record(self, name, start, end):
+        timer = self.timers.setdefault(name, [0.0, 0])
+        timer[0] += end - start
+        timer[1] += 1
+        if self.events is not None:
+            self.events.append({ "name" : name, "ph" : "X", "pid" : os.getpid(), "tid" : threading.get_ident(),
+                                 "ts" : (start - self.start) * 1e6, "dur" : (end - start) * 1e6 })
+
+    def as_dict(self):
+        return { "timers" : {k:{ "seconds" : v[0], "calls" : v[1] } for k,v in self.timers.items()},
+                 "counters" : dict(self.counters),
+                 "panels_per_depth" : dict(sorted(self.depths.items())) }
+
+    def write_trace(self, path):
+        with open(path, "w") as j:
+            json.dump({ "traceEvents" : self.events or [] }, j)
+
+    def __repr__(self):
+        lines = [f"{k:<20} {v[0]:10.4f}s {v[1]:>8} calls" for k,v in sorted(self.timers.items(), key=lambda t: -t[1][0])]
+        lines += [f"{k:<20} {v:>10}" for k,v in sorted(self.counters.items())]
+        lines += [f"panels at depth {k:<4} {v:>10}" for k,v in sorted(self.depths.items())]
+        return "\n".join(lines)
+
+
+class _Phase(object):
+    __slots__ = ("stats", "name", "begin")
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.stats.record(self.name, self.begin, time.perf_counter())
+        return False
+
+
+class _NoPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_no_phase = _NoPhase()
+
+def phase(name):
+    # A context manager timing name, or a shared no-op one when disabled
+    return _no_phase if stats is None else _Phase(stats, name)
+
+def count(name, n=1):
+    if stats is not None:
+        stats.count(name, n)
+
+def count_depth(depth, n=1):
+    if stats is not None:
+        stats.count_depth(depth, n)
+
+def enable(trace=False):
+    global stats
+    stats = Stats(trace)
+    return stats
+
+def disable():
+    global stats
+    previous, stats = stats, None
+    return previous
+
+@contextmanager
+def collect(trace=False):
+    # Collects into a fresh Stats for the duration of the block, restoring any outer one after
+    global stats
+    outer = stats
+    collected = enable(trace)
+    try:
+        yield collected
+    finally:
+        stats = outer
@@ -0,0 +1,195 @@
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+import pandas as pd
+import svgpanels
+from paneltree import PanelTree
+from datasources import DataFrameSource
+
+# A persistent cache of laid-out diagrams. Each entry is a directory of .npy
+# columns - the PanelTree's geometry and ids, its names and labels packed as
+# UTF-8 with offsets, and the fitted title text - so that it can be loaded back
+# memory-mapped, and rendered without partitioning the data or measuring text.
+
+FORMAT_VERSION = 1
+
+
+def fingerprint(data, specification, styles, **params):
+    """A stable hash of a DataFrame's contents, index and dtypes, a template
+    specification, styles, and any other parameters the layout depends on."""
+    h = hashlib.sha256()
+    h.update(json.dumps([FORMAT_VERSION, [str(c) for c in data.columns], [str(d) for d in data.dtypes],
+                         specification, styles, params], sort_keys=True, default=str).encode())
+    h.update(pd.util.hash_pandas_object(data, index=True).to_numpy().tobytes())
+    return h.hexdigest()
+
+def pack_strings(strings):
+    # Concatenated UTF-8 and character offsets, which unpack_strings reverses
+    offsets = np.zeros(len(strings)+1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in strings])
+    return np.frombuffer("".join(strings).encode("utf-8"), dtype=np.uint8), offsets
+
+def unpack_strings(buffer, offsets):
+    text = np.asarray(buffer).tobytes().decode("utf-8")
+    offsets = np.asarray(offsets).tolist()
+    return [text[a:b] for a,b in zip(offsets[:-1], offsets[1:])]
+
+
+class FittedLayout(object):
+    """A PanelTree together with its title text fitted by svgpanels.fit_text: a
+    transform per panel, and the (line, y offset) spans of every panel flattened
+    into span_text and span_y, with panel i's spans at span_start[i]:span_start[i+1]."""
+
+    def __init__(self, tree, transforms, span_text, span_y, span_start, oversize_method="truncate"):
+        self.tree = tree
+        self.transforms = transforms
+        self.span_text = span_text
+        self.span_y = span_y
+        self.span_start = span_start
+        self.oversize_method = oversize_method
+
+    @classmethod
+    def fit(cls, tree, oversize_method="truncate"):
+        panels = [tree[i] for i in range(len(tree))]
+        rectangles = [svgpanels.panel_title(p)[2] for p in panels]
+        transforms, spans = svgpanels.fit_text([p.get_label() for p in panels], rectangles, oversize_method)
+        span_start = np.zeros(len(panels)+1, dtype=np.int64)
+        span_start[1:] = np.cumsum([len(s) for s in spans])
+        return cls(tree, transforms, [l for s in spans for l,y in s],
+                   np.array([y for s in spans for l,y in s], dtype=np.float64), span_start, oversize_method)
+
+    def spans(self, i):
+        a, b = int(self.span_start[i]), int(self.span_start[i+1])
+        return list(zip(self.span_text[a:b], self.span_y[a:b].tolist()))
+
+    def render(self, panel):
+        return svgpanels.fitted_panel(panel, self.transforms[panel.i].tolist(), self.spans(panel.i))
+
+    def svg_stream(self, window_x, window_y, window_w, window_h, screen_w, screen_h, viewport=None):
+        return svgpanels.svg_stream(self.tree.paint_order(viewport=viewport), window_x, window_y, window_w, window_h,
+                                    screen_w, screen_h, self.oversize_method, render=self.render)
+
+    def write_svg(self, fp, window_x, window_y, window_w, window_h, screen_w, screen_h, viewport=None, encoding=None):
+        for chunk in self.svg_stream(window_x, window_y, window_w, window_h, screen_w, screen_h, viewport):
+            fp.write(chunk if encoding is None else chunk.encode(encoding))
+
+    def save(self, path):
+        os.makedirs(path)
+        tree = self.tree
+        columns = {k:getattr(tree, k) for k in tree.columns}
+        columns["names"], columns["name_offsets"] = pack_strings(tree.names)
+        columns["labels"], columns["label_offsets"] = pack_strings(tree.labels)
+        columns["span_text"], columns["span_offsets"] = pack_strings(self.span_text)
+        columns.update(transforms=self.transforms, span_y=self.span_y, span_start=self.span_start)
+        for k,v in columns.items():
+            np.save(os.path.join(path, k + ".npy"), np.ascontiguousarray(v))
+        with open(os.path.join(path, "meta.json"), "w") as j:
+            json.dump({"templates" : tree.templates, "style_names" : tree.style_names, "styles" : tree.styles,
+                       "oversize_method" : self.oversize_method}, j)
+
+    @classmethod
+    def load(cls, path, mmap_mode="r"):
+        column = lambda k: np.load(os.path.join(path, k + ".npy"), mmap_mode=mmap_mode)
+        with open(os.path.join(path, "meta.json"), "r") as j:
+            meta = json.load(j)
+        tree = PanelTree(meta["templates"], meta["style_names"], meta["styles"],
+                         unpack_strings(column("names"), column("name_offsets")),
+                         unpack_strings(column("labels"), column("label_offsets")),
+                         **{k:column(k) for k in PanelTree.columns})
+        return cls(tree, column("transforms"), unpack_strings(column("span_text"), column("span_offsets")),
+                   column("span_y"), column("span_start"), meta["oversize_method"])
+
+
+class LayoutCache(object):
+    """FittedLayouts on disk under path, one directory per fingerprint, holding at
+    most max_bytes in all; the least recently used entries are evicted first. A
+    cache created with enabled=False never reads or writes anything."""
+
+    def __init__(self, path, max_bytes=256*2**20, enabled=True):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.stats = {"hits" : 0, "misses" : 0, "evictions" : 0}
+
+    def entry(self, key):
+        return os.path.join(self.path, key)
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        entry = self.entry(key)
+        if not os.path.exists(os.path.join(entry, "meta.json")):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        os.utime(entry)
+        return FittedLayout.load(entry)
+
+    def put(self, key, layout):
+        if not self.enabled:
+            return
+        entry = self.entry(key)
+        if os.path.exists(entry):
+            return
+        os.makedirs(self.path, exist_ok=True)
+        # Written beside the entry and renamed into place, so readers never see half an entry
+        tmp_path = f"{entry}.{os.getpid()}.tmp"
+        layout.save(tmp_path)
+        try:
+            os.rename(tmp_path, entry)
+        except OSError:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+
+    def entries(self):
+        # (last used, size in bytes, path) of every complete entry
+        if not os.path.isdir(self.path):
+            return []
+        entries = []
+        for name in os.listdir(self.path):
+            entry = os.path.join(self.path, name)
+            if name.endswith(".tmp") or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry, f)) for f in os.listdir(entry))
+            entries.append((os.path.getmtime(entry), size, entry))
+        return sorted(entries)
+
+    def size(self):
+        return sum(size for used, size, entry in self.entries())
+
+    def evict(self, max_bytes=None):
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = self.entries()
+        total = sum(size for used, size, entry in entries)
+        for used, size, entry in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self.evict(0)
+
+
+def cached_layout(data, specification, styles, template="root", query=None, x=0.0, y=0.0, w=1.0, h=1.0,
+                  oversize_method="truncate", cache=None):
+    """Lays out and fits a diagram with PanelTree.build and svgpanels.fit_text, or
+    loads it from cache when data, specification, styles, root box and text
+    settings are unchanged. Only DataFrame data is fingerprinted; other data
+    sources, like cache=None, always lay out afresh."""
+    frame = data.data if isinstance(data, DataFrameSource) else data
+    key = None
+    if cache is not None and cache.enabled and isinstance(frame, pd.DataFrame):
+        key = fingerprint(frame, specification, styles, template=template, query=query, box=(x,y,w,h),
+                          oversize_method=oversize_method, font=svgpanels.arial)
+        layout = cache.get(key)
+        if layout is not None:
+            return layout
+    tree = PanelTree.build(data, specification, styles, template, query, x, y, w, h)
+    layout = FittedLayout.fit(tree, oversize_method)
+    if key is not None:
+        cache.put(key, layout)
+    return layout
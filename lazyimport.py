@@ -0,0 +1,27 @@
+import importlib
+import importlib.util
+import sys
+
+# Heavy optional modules - pandas, PIL, networkx - are bound through lazy_import,
+# so that importing the core modules stays fast and a module is only loaded when
+# a code path first touches one of its attributes.
+
+
+def lazy_import(name):
+    """Returns name as a module that is executed on first attribute access."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+def resolve(path):
+    # The object at a dotted path such as "pandas.DataFrame", importing its module
+    module, _, attribute = path.rpartition(".")
+    return getattr(importlib.import_module(module), attribute)
@@ -0,0 +1,571 @@
+import os
+import numpy as np
+from graphicalpivots import compile_spec, resolve_positions, partition_name
+from datasources import DataSource, DataFrameSource, as_source
+from lazyimport import lazy_import
+import instrumentation
+
+pd = lazy_import("pandas")
+
+# A compact alternative to a tree of graphicalpivots.Panel objects. Every panel
+# is a row in a set of NumPy columns, and the tree is built a level at a time,
+# so the children of each panel are stored contiguously after child_start.
+
+
+class PanelView(object):
+    """A lightweight view of one panel of a PanelTree, exposing the attributes
+    of a Panel that the renderers use."""
+    __slots__ = ("tree", "i")
+
+    def __init__(self, tree, i):
+        self.tree = tree
+        self.i = i
+
+    x = property(lambda self: float(self.tree.x[self.i]))
+    y = property(lambda self: float(self.tree.y[self.i]))
+    w = property(lambda self: float(self.tree.w[self.i]))
+    h = property(lambda self: float(self.tree.h[self.i]))
+    depth = property(lambda self: int(self.tree.depth[self.i]))
+    count = property(lambda self: int(self.tree.count[self.i]))
+    name = property(lambda self: self.tree.names[self.i])
+    template = property(lambda self: self.tree.templates[self.tree.template[self.i]])
+    style = property(lambda self: self.tree.styles[self.tree.style_names[self.tree.style[self.i]]])
+
+    @property
+    def parent(self):
+        p = int(self.tree.parent[self.i])
+        return None if p < 0 else PanelView(self.tree, p)
+
+    @property
+    def children(self):
+        return [PanelView(self.tree, c) for c in self.tree.children(self.i)]
+
+    def get_label(self):
+        # Collapsed panels summarise the rows beneath them
+        if self.tree.collapsed[self.i]:
+            return f"{self.tree.labels[self.i]} ({self.count} rows)"
+        return self.tree.labels[self.i]
+
+    def __eq__(self, other):
+        return isinstance(other, PanelView) and other.tree is self.tree and other.i == self.i
+
+    def __hash__(self):
+        return hash((id(self.tree), self.i))
+
+    def __repr__(self):
+        return str((self.name, self.template, len(self.tree.children(self.i)), self.x, self.y))
+
+
+class PanelTree(object):
+    """Panel geometry, depth, parent index, template and style ids, row counts and
+    labels held in struct-of-arrays form. Build one directly from data with
+    PanelTree.build, or convert an existing Panel tree with PanelTree.from_panel."""
+
+    columns = { "x" : np.float64, "y" : np.float64, "w" : np.float64, "h" : np.float64,
+                "depth" : np.int32, "parent" : np.int64, "template" : np.int32, "style" : np.int32,
+                "child_start" : np.int64, "child_count" : np.int64,
+                "count" : np.int64, "row" : np.int64, "collapsed" : bool }
+
+    def __init__(self, templates, style_names, styles, names, labels, **columns):
+        self.templates = templates
+        self.style_names = style_names
+        self.styles = styles
+        self.names = names
+        self.labels = labels
+        for k,dtype in self.columns.items():
+            setattr(self, k, np.asarray(columns.get(k, np.zeros(len(names))), dtype=dtype))
+        # Row positions of collapsed panels, kept so that they can be expanded later
+        self.pending = {}
+        self.builder = None
+        self.query = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return PanelView(self, i)
+
+    @property
+    def root(self):
+        return PanelView(self, 0)
+
+    def children(self, i):
+        start = int(self.child_start[i])
+        return range(start, start + int(self.child_count[i]))
+
+    def preorder(self, i=0):
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            yield PanelView(self, i)
+            stack.extend(reversed(self.children(i)))
+
+    def postorder(self, i=0):
+        stack = [(i, False)]
+        while stack:
+            i, expanded = stack.pop()
+            if expanded:
+                yield PanelView(self, i)
+            else:
+                stack.append((i, True))
+                stack.extend((c, False) for c in reversed(self.children(i)))
+
+    def paint_order(self, i=0, viewport=None):
+        # As Panel.paint_order - each panel before its children, later siblings first.
+        # Children lie within their parent, so subtrees outside a viewport are culled.
+        stack = [i]
+        while stack:
+            i = stack.pop()
+            if viewport is not None and not self.intersects(i, viewport):
+                continue
+            yield PanelView(self, i)
+            stack.extend(self.children(i))
+
+    def intersects(self, i, viewport):
+        vx,vy,vw,vh = viewport
+        return (self.x[i] < vx+vw and vx < self.x[i]+self.w[i] and
+                self.y[i] < vy+vh and vy < self.y[i]+self.h[i])
+
+    @classmethod
+    def build(cls, data, specification, styles, template="root", query=None,
+              x=0.0, y=0.0, w=1.0, h=1.0, plan=None, engine=None,
+              viewport=None, min_size=0.0, scale=1.0):
+        """Lays out a tree directly from data, a DataFrame or any datasources
+        DataSource, with query in the source's own syntax. If a viewport (x,y,w,h)
+        or a min_size is given, only panels that intersect the viewport and are at
+        least min_size on screen (at scale screen units per diagram unit) have
+        their children expanded; the rest are left collapsed, and can be expanded
+        later with expand() as the view changes."""
+        if plan is None:
+            plan = compile_spec(specification, styles)
+        source = as_source(data) if engine is None else DataFrameSource(data, engine)
+        tree = cls(list(plan.templates), list(styles), styles, [], [], **{k:[] for k in cls.columns})
+        tree.builder = _TreeBuilder(tree, source, plan)
+        tree.query = query
+        selection = tree.builder.append_root(template, (x,y,w,h), query)
+        tree.builder.expand([(0, selection)], viewport, min_size, scale)
+        return tree
+
+    @classmethod
+    def build_parallel(cls, data, specification, styles, template="root", query=None,
+                       x=0.0, y=0.0, w=1.0, h=1.0, viewport=None, min_size=0.0, scale=1.0,
+                       max_workers=None, executor=None):
+        """As build, but with independent subtrees laid out in a process pool. The
+        top of the tree is expanded here until a level has at least one panel per
+        worker; each worker then receives only its subtree's rows, cut down to the
+        columns the specification uses, and the subtrees are merged back in
+        partition order, so the result is identical to build's. An executor may be
+        passed in to reuse a pool, along with its max_workers."""
+        if isinstance(data, DataSource):
+            raise ValueError("build_parallel needs a DataFrame, not a DataSource")
+        if executor is not None and max_workers is None:
+            raise ValueError("build_parallel needs max_workers to split the tree for a given executor")
+        workers = (os.cpu_count() or 1) if max_workers is None else max_workers
+        plan = compile_spec(specification, styles)
+        tree = cls(list(plan.templates), list(styles), styles, [], [], **{k:[] for k in cls.columns})
+        tree.builder = builder = _TreeBuilder(tree, DataFrameSource(data), plan)
+        tree.query = query
+        rows = builder.append_root(template, (x,y,w,h), query)
+
+        own_executor = executor is None
+        if own_executor:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(workers)
+        frontier = [(0, rows)]
+        while frontier and len(frontier) < workers:
+            frontier = builder.expand_level(frontier, viewport, min_size, scale)
+        builder.finish()
+
+        fields = sorted(f for f in _plan_fields(plan) if f in data.columns)
+        jobs, nodes = [], []
+        for node, rows in frontier:
+            jobs.append((data.iloc[rows][fields], specification, styles, tree.templates[tree.template[node]],
+                         (tree.x[node], tree.y[node], tree.w[node], tree.h[node]), viewport, min_size, scale))
+            nodes.append((node, rows))
+        try:
+            for (node, rows), sub in zip(nodes, executor.map(_build_subtree, jobs)):
+                tree._graft(node, rows, sub)
+        finally:
+            if own_executor:
+                executor.shutdown()
+        return tree
+
+    def _graft(self, node, rows, sub):
+        # Attaches sub, built from data.iloc[rows], in place of the childless panel node
+        n = len(sub)
+        ids = np.empty(n, dtype=np.int64)
+        ids[0] = node
+        ids[1:] = len(self) + np.arange(n-1)
+        for k in ("child_start", "child_count", "collapsed"):
+            getattr(self, k)[node] = getattr(sub, k)[0]
+        has_children = sub.child_count > 0
+        sub.child_start[has_children] = ids[sub.child_start[has_children]]
+        self.child_start[node] = sub.child_start[0]
+        sub.parent[1:] = ids[sub.parent[1:]]
+        sub.depth += self.depth[node]
+        sub.row[sub.row >= 0] = rows[sub.row[sub.row >= 0]]
+        for k in self.columns:
+            setattr(self, k, np.concatenate([getattr(self, k), getattr(sub, k)[1:]]))
+        self.names.extend(sub.names[1:])
+        self.labels.extend(sub.labels[1:])
+        for i, pending in sub.pending.items():
+            self.pending[int(ids[i])] = rows[pending]
+        self.builder.base = len(self)
+
+    def expand(self, viewport=None, min_size=0.0, scale=1.0):
+        # Expands collapsed panels that now meet the viewport and size conditions
+        if self.builder is None or not self.pending:
+            return
+        frontier = sorted(self.pending.items())
+        self.pending = {}
+        self.builder.expand(frontier, viewport, min_size, scale)
+
+    def path(self, i):
+        # Panel names from below the root down to panel i, which identify it across updates
+        names = []
+        while i > 0:
+            names.append(self.names[i])
+            i = int(self.parent[i])
+        return tuple(names[::-1])
+
+    def update(self, data=None, specification=None, styles=None, changed=None):
+        """Re-lays out the tree for new data and/or a new specification or styles,
+        returning the new tree and a TreeChanges report. Only panels that contain
+        changed rows are re-partitioned, and only panels whose parent box, sibling
+        count, layout or style changed have their geometry recomputed; everything
+        else is copied across. changed may list the index labels of changed rows,
+        otherwise they are found by comparing the fields the specification uses,
+        which requires a unique index."""
+        # Other sources, AggregateSource included, number rows in their own way
+        if self.builder is None or type(self.builder.source) is not DataFrameSource:
+            raise ValueError("Only trees built by PanelTree.build from a DataFrame can be updated")
+        old_plan, old_data = self.builder.plan, self.builder.source.data
+        data = old_data if data is None else data
+        if specification is None and styles is None:
+            plan = old_plan
+        else:
+            plan = compile_spec(old_plan.specification if specification is None else specification,
+                                self.styles if styles is None else styles)
+        styles = plan.styles
+
+        # A change in how any template partitions its rows affects every panel
+        rebuild_all = (list(plan.templates) != list(old_plan.templates) or
+                       any(plan[t].fields != old_plan[t].fields or plan[t].successors != old_plan[t].successors
+                           for t in plan.templates))
+        dirty = set()
+        remap = None
+        if data is not old_data:
+            if not (data.index.is_unique and old_data.index.is_unique):
+                raise ValueError("Incremental updates need a unique index on the data")
+            if changed is None:
+                changed = _changed_rows(old_data, data, _plan_fields(old_plan) | _plan_fields(plan))
+            remap = data.index.get_indexer(old_data.index)
+            dirty = _dirty_paths(old_data, old_plan, self.templates[self.template[0]], changed) | \
+                    _dirty_paths(data, plan, self.templates[self.template[0]], changed)
+
+        tree = PanelTree(list(plan.templates), list(styles), styles, [], [], **{k:[] for k in self.columns})
+        source = DataFrameSource(data) if data is not old_data else self.builder.source
+        tree.builder = builder = _TreeBuilder(tree, source, plan)
+        tree.query = self.query
+        changes = TreeChanges()
+        matched = set()
+
+        def remapped(rows):
+            return rows if remap is None else remap[rows][remap[rows] >= 0]
+
+        def rows_of(node):
+            # Rows of a copied panel, found by splitting the rows of its ancestors again
+            path = [node]
+            while path[-1] not in selections:
+                path.append(builder.get("parent", path[-1]))
+            for parent in reversed(path[1:]):
+                p_plan = plan[tree.templates[builder.get("template", parent)]]
+                start = builder.get("child_start", parent)
+                nodes = {tree.names[c]:c for c in range(start, start + builder.get("child_count", parent))}
+                for name, key, index in source.engine.split(selections[parent], p_plan.fields):
+                    if name in nodes:
+                        selections[nodes[name]] = index
+            return selections[node]
+
+        rows = builder.append_root(self.templates[self.template[0]], (self.x[0], self.y[0], self.w[0], self.h[0]),
+                                   self.query, self.names[0])
+        selections = {0: rows}
+        frontier = [(0, 0, rows, ())]
+        while frontier:
+            next_frontier = []
+            for node, old, rows, path in frontier:
+                t_plan = plan[tree.templates[builder.get("template", node)]]
+                if old is None:
+                    changes.added.append(node)
+                else:
+                    matched.add(old)
+                    box = tuple(builder.get(k, node) for k in ("x","y","w","h"))
+                    if box != (self.x[old], self.y[old], self.w[old], self.h[old]):
+                        changes.moved.append((old, node))
+                    if builder.get("count", node) != self.count[old] or tree.labels[node] != self.labels[old]:
+                        changes.changed.append((old, node))
+                if not t_plan.successors:
+                    continue
+                if old is not None and self.collapsed[old]:
+                    builder.set("collapsed", node, True)
+                    tree.pending[node] = rows if rows is not None else remapped(self.pending[old])
+                    continue
+                parent = tuple(builder.get(k, node) for k in ("x","y","w","h"))
+                old_children = {} if old is None else {self.names[c]:c for c in self.children(old)}
+                builder.set("child_start", node, len(tree.names))
+                depth = builder.get("depth", node) + 1
+                if rebuild_all or old is None or path in dirty:
+                    # Re-partition, reusing nothing but the identity of surviving children
+                    canvas = None
+                    for s in t_plan.successors:
+                        partition = source.partition_level([rows], t_plan.fields, plan[s].label_template.fields)[0]
+                        if canvas is None:
+                            canvas = resolve_positions(parent, t_plan.style, t_plan.positions([p[1] for p in partition])).tolist()
+                        for (name, key, index, count, row, values), box in zip(partition, canvas):
+                            child = builder.append(name, plan[s], box, depth, node, count, row, builder.label(plan[s], values))
+                            next_frontier.append((child, old_children.get(name), index, path+(name,)))
+                else:
+                    # Same children as before - copy them, recomputing geometry only if it can have changed
+                    old_t = old_plan[self.templates[self.template[old]]]
+                    kids = list(self.children(old))
+                    same = (parent == (self.x[old], self.y[old], self.w[old], self.h[old]) and
+                            t_plan.layout is old_t.layout and t_plan.spacing == old_t.spacing and
+                            t_plan.style == old_t.style)
+                    if same:
+                        canvas = [(self.x[c], self.y[c], self.w[c], self.h[c]) for c in kids]
+                    elif t_plan.matrix:
+                        # Matrix cells are placed by their keys, so split the panel's rows again for them
+                        rows = rows_of(node) if rows is None else rows
+                        keys = [key for name, key, index in source.engine.split(rows, t_plan.fields)]
+                        canvas = resolve_positions(parent, t_plan.style, t_plan.positions(keys)).tolist()
+                    else:
+                        canvas = resolve_positions(parent, t_plan.style, t_plan.local_positions(len(kids))).tolist()
+                    for c, box in zip(kids, canvas):
+                        c_plan = plan[self.templates[self.template[c]]]
+                        row = int(self.row[c]) if remap is None else int(remap[self.row[c]])
+                        if c_plan.label == old_plan[c_plan.name].label:
+                            label = self.labels[c]
+                        else:
+                            label = c_plan.label_template.format_rows(source.data, [row])[0]
+                        child = builder.append(self.names[c], c_plan, box, depth, node, int(self.count[c]), row, label)
+                        next_frontier.append((child, c, None, path+(self.names[c],)))
+                builder.set("child_count", node, len(tree.names) - builder.get("child_start", node))
+            frontier = next_frontier
+        builder.finish()
+        changes.removed = [i for i in range(len(self)) if i not in matched]
+        return tree, changes
+
+    @classmethod
+    def from_panel(cls, root, styles):
+        # Converts a tree of graphicalpivots.Panel, laid out by genchildren
+        templates, style_names = list(root.specification), list(styles)
+        template_ids = {t:e for e,t in enumerate(templates)}
+        style_ids = {s:e for e,s in enumerate(style_names)}
+        cols = {k:[] for k in cls.columns}
+        names, labels = [], []
+        frontier = [(root, -1, 0)]
+        while frontier:
+            next_frontier = []
+            for panel, parent, depth in frontier:
+                node = len(names)
+                if parent >= 0 and cols["child_count"][parent] == 0:
+                    cols["child_start"][parent] = node
+                if parent >= 0:
+                    cols["child_count"][parent] += 1
+                rows = panel.rows()
+                for k in ("x","y","w","h"):
+                    cols[k].append(getattr(panel, k))
+                cols["depth"].append(depth)
+                cols["parent"].append(parent)
+                cols["template"].append(template_ids[panel.template])
+                cols["style"].append(style_ids[panel.specification[panel.template]['style']])
+                cols["child_start"].append(0)
+                cols["child_count"].append(0)
+                cols["count"].append(len(rows))
+                cols["row"].append(rows[-1] if len(rows) else -1)
+                cols["collapsed"].append(False)
+                names.append(panel.name)
+                labels.append(panel.get_label())
+                next_frontier.extend((c, node, depth+1) for c in getattr(panel, "children", []))
+            frontier = next_frontier
+        return cls(templates, style_names, styles, names, labels, **cols)
+
+
+class TreeChanges(object):
+    """The panels affected by PanelTree.update. moved and changed hold (old, new)
+    index pairs for panels whose box, or whose label or row count, changed;
+    added holds new indices and removed old ones."""
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.moved = []
+        self.changed = []
+
+    def __repr__(self):
+        return str({k:len(v) for k,v in self.__dict__.items()})
+
+
+def apply_delta(data, inserts=None, deletes=None, updates=None):
+    # Returns a copy of data with the rows labelled by deletes dropped, the cells
+    # in updates overwritten, and the rows of inserts appended
+    data = data.drop(index=deletes) if deletes is not None else data.copy()
+    if updates is not None:
+        data.loc[updates.index, updates.columns] = updates
+    if inserts is not None:
+        data = pd.concat([data, inserts])
+    return data
+
+def _plan_fields(plan):
+    fields = set()
+    for t in plan.templates.values():
+        fields.update(t.fields or [])
+        fields.update(t.label_template.fields)
+    return fields
+
+def _changed_rows(old, new, fields):
+    fields = [f for f in fields if f in old.columns and f in new.columns]
+    common = old.index.intersection(new.index)
+    a, b = old.loc[common, fields], new.loc[common, fields]
+    differs = ~(a.eq(b) | (a.isna() & b.isna())).all(axis=1)
+    return old.index.symmetric_difference(new.index).append(common[differs.to_numpy()])
+
+def _dirty_paths(data, plan, template, changed):
+    # Every path from the root to a panel that contains one of the changed rows
+    changed = data.index.intersection(changed)
+    paths = set()
+    if len(changed):
+        paths.add(())
+    for record in data.loc[changed].to_dict("records"):
+        path, t = (), template
+        while plan[t].successors:
+            path = path + (partition_name(plan[t].fields, tuple(record[f] for f in plan[t].fields)),)
+            paths.add(path)
+            t = plan[t].successors[0]
+    return paths
+
+def _build_subtree(job):
+    data, specification, styles, template, box, viewport, min_size, scale = job
+    tree = PanelTree.build(data, specification, styles, template, None, *box,
+                           viewport=viewport, min_size=min_size, scale=scale)
+    tree.builder = None # the data stays behind in the worker
+    return tree
+
+def viewbox_scale(window_w, window_h, screen_w, screen_h):
+    # Screen units per diagram unit for svgpanels.svg_viewbox's default aspect handling
+    return min(screen_w/window_w, screen_h/window_h)
+
+
+class _TreeBuilder(object):
+    # Grows a PanelTree a level at a time through a DataSource. New panels are gathered
+    # in lists and appended to the tree's columns once a call to expand has finished.
+
+    def __init__(self, tree, source, plan):
+        self.tree = tree
+        self.source = source
+        self.plan = plan
+        self.template_ids = {t:e for e,t in enumerate(tree.templates)}
+        self.style_ids = {s:e for e,s in enumerate(tree.style_names)}
+        self.base = len(tree)
+        self.cols = {k:[] for k in tree.columns}
+
+    def label(self, t_plan, values):
+        # Fills the label template from a panel's last row, as Panel.get_label does
+        if not t_plan.label_template.fields or not values:
+            return t_plan.label
+        return t_plan.label_template.format(values)
+
+    def get(self, k, node):
+        return getattr(self.tree, k)[node] if node < self.base else self.cols[k][node-self.base]
+
+    def set(self, k, node, value):
+        if node < self.base:
+            getattr(self.tree, k)[node] = value
+        else:
+            self.cols[k][node-self.base] = value
+
+    def append(self, name, t_plan, box, depth, parent, count, row, label):
+        cols = self.cols
+        cols["x"].append(box[0]); cols["y"].append(box[1]); cols["w"].append(box[2]); cols["h"].append(box[3])
+        cols["depth"].append(depth)
+        cols["parent"].append(parent)
+        cols["template"].append(self.template_ids[t_plan.name])
+        cols["style"].append(self.style_ids[t_plan.style_name])
+        cols["child_start"].append(0)
+        cols["child_count"].append(0)
+        cols["count"].append(count)
+        cols["row"].append(row)
+        cols["collapsed"].append(False)
+        self.tree.names.append(name)
+        self.tree.labels.append(label)
+        return len(self.tree.names)-1
+
+    def append_root(self, template, box, query, name=None):
+        # Appends the root panel, returning its selection
+        selection = self.source.root(query)
+        count, row, values = self.source.describe(selection, self.plan[template].label_template.fields)
+        t_plan = self.plan[template]
+        self.append(template if name is None else name, t_plan, box, 0, -1, count, row, self.label(t_plan, values))
+        instrumentation.count_depth(0)
+        return selection
+
+    def visible(self, box, viewport, min_size, scale):
+        x,y,w,h = box
+        if min(w,h)*scale < min_size:
+            return False
+        if viewport is None:
+            return True
+        vx,vy,vw,vh = viewport
+        return x < vx+vw and vx < x+w and y < vy+vh and vy < y+h
+
+    def expand(self, frontier, viewport, min_size, scale):
+        while frontier:
+            frontier = self.expand_level(frontier, viewport, min_size, scale)
+        self.finish()
+
+    def expand_level(self, frontier, viewport, min_size, scale):
+        # Expands one level of (node, selection) pairs, returning those of their children.
+        # The source splits every selection of a template in one call.
+        with instrumentation.phase("expand_level"):
+            return self._expand_level(frontier, viewport, min_size, scale)
+
+    def _expand_level(self, frontier, viewport, min_size, scale):
+        templates = self.tree.templates
+        expanding = {}
+        for node, selection in frontier:
+            t_plan = self.plan[templates[self.get("template", node)]]
+            if not t_plan.successors:
+                continue
+            parent = tuple(self.get(k, node) for k in ("x","y","w","h"))
+            if not self.visible(parent, viewport, min_size, scale):
+                self.set("collapsed", node, True)
+                self.tree.pending[node] = selection
+                continue
+            self.set("collapsed", node, False)
+            expanding.setdefault(t_plan.name, []).append((node, selection, parent))
+
+        next_frontier = []
+        for t_name, items in expanding.items():
+            t_plan = self.plan[t_name]
+            for s in t_plan.successors:
+                s_plan = self.plan[s]
+                with instrumentation.phase("partition_level"):
+                    partitions = self.source.partition_level([selection for node, selection, parent in items],
+                                                             t_plan.fields, s_plan.label_template.fields)
+                for (node, selection, parent), partition in zip(items, partitions):
+                    with instrumentation.phase("layout"):
+                        canvas = resolve_positions(parent, t_plan.style, t_plan.positions([p[1] for p in partition])).tolist()
+                    self.set("child_start", node, len(self.tree.names))
+                    depth = self.get("depth", node) + 1
+                    instrumentation.count_depth(depth, len(partition))
+                    for (name, key, child_selection, count, row, values), box in zip(partition, canvas):
+                        child = self.append(name, s_plan, box, depth, node, count, row, self.label(s_plan, values))
+                        next_frontier.append((child, child_selection))
+                    self.set("child_count", node, len(self.tree.names) - self.get("child_start", node))
+        return next_frontier
+
+    def finish(self):
+        for k,dtype in self.tree.columns.items():
+            setattr(self.tree, k, np.concatenate([getattr(self.tree, k), np.asarray(self.cols[k], dtype=dtype)]))
+        self.base = len(self.tree)
+        self.cols = {k:[] for k in self.tree.columns}
@@ -0,0 +1,130 @@
+import os
+import numpy as np
+from PIL import Image, ImageDraw
+import svgpanels
+from instrumentation import phase, count
+
+# A raster counterpart to svgpanels, drawing laid-out panels straight to an image.
+# Panels are gathered into arrays once, mapped to pixels and culled together, and
+# their title bars, canvases and outlines are filled as NumPy slices; only titles
+# tall enough to read are drawn as text, with PIL. Panels that round away to
+# nothing at the output size are never touched, so the cost follows the pixels
+# drawn rather than the number of panels. Corners are drawn square.
+
+title_colour = (255, 192, 203)
+canvas_colour = (255, 255, 255)
+line_colour = (0, 0, 0)
+text_colour = (0, 0, 0)
+
+
+class Scene(object):
+    """Panels, given in paint order (e.g. Panel.paint_order()), as arrays of their
+    boxes and title heights, plus their labels."""
+
+    def __init__(self, panels):
+        rows, labels = [], []
+        for panel in panels:
+            r, th, title = svgpanels.panel_title(panel)
+            rows.append((panel.x, panel.y, panel.w, panel.h, th) + tuple(title))
+            labels.append(panel.get_label())
+        rows = np.asarray(rows, dtype=np.float64).reshape(len(rows), 9)
+        self.x, self.y, self.w, self.h, self.th = rows[:,:5].T
+        self.title = rows[:,5:]
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def render(self, window_x, window_y, window_w, window_h, screen_w, screen_h, tile=None,
+               background=(255, 255, 255), text=True, min_text=6):
+        """Draws the window onto a screen_w by screen_h image, scaled and centred as
+        svg_viewbox's default aspect handling would. tile, an (x, y, w, h) pixel
+        rectangle of that image, draws just that part of it."""
+        with phase("raster"):
+            scale = min(screen_w/window_w, screen_h/window_h)
+            ox = (screen_w - window_w*scale)/2 - window_x*scale
+            oy = (screen_h - window_h*scale)/2 - window_y*scale
+            tx, ty, tw, th = (0, 0, screen_w, screen_h) if tile is None else tile
+            ox, oy = ox - tx, oy - ty
+            image = np.empty((int(th), int(tw), 3), dtype=np.uint8)
+            image[:] = background
+            to_px = lambda v, o: np.rint(v*scale + o).astype(np.int64)
+            x0, y0 = to_px(self.x, ox), to_px(self.y, oy)
+            x1, y1 = to_px(self.x + self.w, ox), to_px(self.y + self.h, oy)
+            yt = to_px(self.y + self.th, oy)
+            # Cull panels outside the image or with no area left at this scale
+            shown = (x1 > x0) & (y1 > y0) & (x1 > 0) & (y1 > 0) & (x0 < tw) & (y0 < th)
+            count("raster_panels", int(shown.sum()))
+            for i, a, b, c, d, t in zip(np.flatnonzero(shown).tolist(), x0[shown].tolist(), y0[shown].tolist(),
+                                         x1[shown].tolist(), y1[shown].tolist(), yt[shown].tolist()):
+                _fill(image, a, b, c, min(t, d), title_colour)
+                _fill(image, a, max(t, b), c, d, canvas_colour)
+                _fill(image, a, b, c, b+1, line_colour)
+                _fill(image, a, d-1, c, d, line_colour)
+                _fill(image, a, b, a+1, d, line_colour)
+                _fill(image, c-1, b, c, d, line_colour)
+                if b < t < d:
+                    _fill(image, a, t, c, t+1, line_colour)
+            image = Image.fromarray(image)
+            if text:
+                self._draw_text(image, scale, ox, oy, shown, min_text)
+        return image
+
+    def _draw_text(self, image, scale, ox, oy, shown, min_text):
+        draw = ImageDraw.Draw(image)
+        tx, ty, tw, th = (self.title * scale).T
+        tx, ty = tx + ox, ty + oy
+        legible = shown & (th >= min_text) & (tw >= min_text) & \
+                  (tx < image.width) & (ty < image.height) & (tx + tw > 0) & (ty + th > 0)
+        for i in np.flatnonzero(legible).tolist():
+            label = self.labels[i].replace("\n", " ")
+            size = int(th[i])
+            font = svgpanels.font_cache.font(svgpanels.arial, size)
+            length = font.getlength(label)
+            if length > tw[i]:
+                # Shrink to fit the width, truncating once text would be illegible
+                size = max(int(size * tw[i] / length), min_text)
+                font = svgpanels.font_cache.font(svgpanels.arial, size)
+                length = font.getlength(label)
+                if length > tw[i]:
+                    keep = int(len(label) * tw[i] / length)
+                    while keep > 0 and font.getlength(label[:keep] + "...") > tw[i]:
+                        keep -= 1
+                    label = label[:keep] + "..."
+            count("raster_text")
+            draw.text((tx[i], ty[i] + (th[i] - size) / 2), label, fill=text_colour, font=font)
+
+    def tiles(self, window_x, window_y, window_w, window_h, screen_w, screen_h, tile_size=512, **kwargs):
+        # Yields (column, row, image) for each tile_size square tile of the full image
+        for row, ty in enumerate(range(0, int(screen_h), tile_size)):
+            for column, tx in enumerate(range(0, int(screen_w), tile_size)):
+                tile = (tx, ty, min(tile_size, screen_w - tx), min(tile_size, screen_h - ty))
+                yield column, row, self.render(window_x, window_y, window_w, window_h, screen_w, screen_h,
+                                               tile=tile, **kwargs)
+
+def _fill(image, x0, y0, x1, y1, colour):
+    # Fills a pixel rectangle, clipped to the image
+    x0, y0 = max(x0, 0), max(y0, 0)
+    if x1 > x0 and y1 > y0:
+        image[y0:y1, x0:x1] = colour
+
+def write_png(fp, panels, window_x, window_y, window_w, window_h, screen_w, screen_h, **kwargs):
+    # The raster counterpart of svgpanels.write_svg, to a path or binary file-like object
+    Scene(panels).render(window_x, window_y, window_w, window_h, screen_w, screen_h, **kwargs).save(fp, "PNG")
+
+def write_tiles(directory, panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                tile_size=512, **kwargs):
+    # Writes the image as tile_size tiles named {row}_{column}.png, returning their paths
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for column, row, image in Scene(panels).tiles(window_x, window_y, window_w, window_h, screen_w, screen_h,
+                                                  tile_size, **kwargs):
+        paths.append(os.path.join(directory, f"{row}_{column}.png"))
+        image.save(paths[-1], "PNG")
+    return paths
+
+def preview(panels, window_x, window_y, window_w, window_h, max_size=256, **kwargs):
+    # A thumbnail no larger than max_size pixels a side, drawn at that size rather than downsampled
+    scale = max_size / max(window_w, window_h)
+    return Scene(panels).render(window_x, window_y, window_w, window_h,
+                                max(int(window_w*scale), 1), max(int(window_h*scale), 1), **kwargs)
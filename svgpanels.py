@@ -1,6 +1,19 @@
 from math import sqrt
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
 from sys import platform
+from collections import OrderedDict
+import json
+import os
+import re
+import gzip
+from html import escape
+from instrumentation import phase, count
+from lazyimport import lazy_import
+
+# PIL is loaded when the first font is, rather than on import
+Image = lazy_import("PIL.Image")
+ImageDraw = lazy_import("PIL.ImageDraw")
+ImageFont = lazy_import("PIL.ImageFont")
 
 if platform == "darwin":
     arial='/Library/Fonts/Arial.ttf' # Apple fonts location
@@ -9,8 +22,334 @@ elif platform =="linux":
 else:
     pass
 
-def svg_viewbox(window_x, window_y, window_w, window_h, screen_w, screen_h, content=""):
-    return f"""<svg xmlns="http://www.w3.org/2000/svg" viewBox="{window_x} {window_y} {window_w} {window_h}" width="{screen_w}" height="{screen_h}" > {content} </svg>"""
+class FontCache(object):
+    """Holds loaded fonts in a bounded LRU keyed by (path, size), and memoizes text
+    measurements keyed by (measure, path, size, text). If memo_path is given, the
+    memo is loaded from it on creation and written back by save(), so that a warm
+    restart can skip measuring text it has already seen."""
+
+    def __init__(self, maxsize=16, memo_path=None):
+        self.maxsize = maxsize
+        self.memo_path = memo_path
+        self.fonts = OrderedDict()
+        self.memo = {}
+        self.stats = {"font_hits" : 0, "font_misses" : 0, "memo_hits" : 0, "memo_misses" : 0}
+        self._draw = None
+        self.glyph_tables = {}
+        if memo_path is not None and os.path.exists(memo_path):
+            self.load(memo_path)
+
+    def font(self, path, size):
+        key = (path, size)
+        if key in self.fonts:
+            self.stats["font_hits"] += 1
+            count("font_hits")
+            self.fonts.move_to_end(key)
+            return self.fonts[key]
+        self.stats["font_misses"] += 1
+        count("font_loads")
+        with phase("font_load"):
+            font = self.fonts[key] = ImageFont.truetype(path, size)
+        # A maxsize of 0 evicts the font at once, so fonts are never kept
+        while len(self.fonts) > self.maxsize:
+            self.fonts.popitem(last=False)
+        return font
+
+    def draw(self):
+        # A single scratch surface is enough for textbbox measurements
+        if self._draw is None:
+            self._draw = ImageDraw.Draw(Image.new("RGB", (20,20)))
+        return self._draw
+
+    def glyph_table(self, path, size):
+        key = (path, size)
+        if key not in self.glyph_tables:
+            with phase("glyph_table"):
+                self.glyph_tables[key] = GlyphTable(self.font(path, size))
+        return self.glyph_tables[key]
+
+    def measure(self, measure, path, size, text, fn):
+        key = (measure, path, size, text)
+        if key in self.memo:
+            self.stats["memo_hits"] += 1
+            count("measure_hits")
+        else:
+            self.stats["memo_misses"] += 1
+            count("measure_misses")
+            with phase("measure"):
+                self.memo[key] = fn(self.font(path, size), text)
+        return self.memo[key]
+
+    def load(self, memo_path):
+        with open(memo_path, "r") as j:
+            for measure, path, size, text, value in json.load(j):
+                self.memo[(measure, path, size, text)] = tuple(value)
+
+    def save(self, memo_path=None):
+        memo_path = memo_path or self.memo_path
+        tmp_path = memo_path + ".tmp"
+        with open(tmp_path, "w") as j:
+            json.dump([list(k) + [list(v)] for k,v in self.memo.items()], j)
+        os.replace(tmp_path, memo_path)
+
+    def clear(self):
+        self.fonts.clear()
+        self.memo.clear()
+        self.glyph_tables.clear()
+        for k in self.stats:
+            self.stats[k] = 0
+
+
+class GlyphTable(object):
+    """Advance widths, vertical extents and pair kerning for the glyphs of one font
+    at one size. The table is measured once with PIL, after which whole batches of
+    single-line strings are measured by summing table entries with NumPy."""
+    line_gap = 4 # PIL's default spacing between the lines of multiline text
+    dense = 256  # Glyphs below this code point are tabulated up front
+    kerned = 128 # Kerning is tabulated for printable ASCII pairs
+
+    def __init__(self, font):
+        self.font = font
+        self.ascent, self.descent = font.getmetrics()
+        self.line_spacing = font.getbbox("A")[3] + self.line_gap
+        self.advance = np.zeros(self.dense)
+        self.top = np.zeros(self.dense)
+        self.bottom = np.zeros(self.dense)
+        for c in range(self.dense):
+            self.advance[c], self.top[c], self.bottom[c] = self._glyph(chr(c))
+        self.extra = {}
+        self.kerning = np.zeros((self.kerned, self.kerned))
+        for a in range(32, self.kerned-1):
+            for b in range(32, self.kerned-1):
+                pair = self.font.getlength(chr(a)+chr(b))
+                self.kerning[a,b] = pair - self.advance[a] - self.advance[b]
+
+    def _glyph(self, c):
+        bbox = self.font.getbbox(c)
+        return self.font.getlength(c), bbox[1], bbox[3]
+
+    def lookup(self, codes):
+        dense = codes < self.dense
+        if dense.all():
+            return self.advance[codes], self.top[codes], self.bottom[codes]
+        metrics = np.empty((len(codes), 3))
+        metrics[dense] = np.column_stack([self.advance[codes[dense]], self.top[codes[dense]], self.bottom[codes[dense]]])
+        sparse = ~dense
+        for c in np.unique(codes[sparse]).tolist():
+            if c not in self.extra:
+                self.extra[c] = self._glyph(chr(c))
+        metrics[sparse] = [self.extra[c] for c in codes[sparse].tolist()]
+        return metrics[:,0], metrics[:,1], metrics[:,2]
+
+    def measure_lines(self, lines):
+        """Returns the widths, topmost and bottommost pixel rows of each string in
+        lines, as textbbox would report them for single-line text."""
+        n = len(lines)
+        lengths = np.fromiter((len(l) for l in lines), dtype=np.int64, count=n)
+        widths = np.zeros(n)
+        tops = np.full(n, float(self.ascent))
+        bottoms = np.full(n, float(self.ascent))
+        if lengths.sum() == 0:
+            return widths, tops, bottoms
+        codes = np.frombuffer("".join(lines).encode("utf-32-le"), dtype="<u4").astype(np.int64)
+        advance, top, bottom = self.lookup(codes)
+        starts = np.cumsum(lengths) - lengths
+        # Kerning is credited to the second glyph of each pair, and never across lines
+        kerned = np.zeros(len(codes))
+        pair = (codes[:-1] < self.kerned) & (codes[1:] < self.kerned)
+        kerned[1:][pair] = self.kerning[codes[:-1][pair], codes[1:][pair]]
+        kerned[starts[lengths > 0]] = 0
+        nonempty = lengths > 0
+        widths[nonempty] = np.add.reduceat(advance + kerned, starts[nonempty])
+        tops[nonempty] = np.minimum.reduceat(top, starts[nonempty])
+        bottoms[nonempty] = np.maximum.reduceat(bottom, starts[nonempty])
+        return widths, tops, bottoms
+
+font_cache = FontCache()
+
+xlink_namespace = "http://www.w3.org/1999/xlink"
+
+def svg_viewbox(window_x, window_y, window_w, window_h, screen_w, screen_h, content="", xlink=False):
+    # xlink declares the xlink namespace, for documents with <use xlink:href> references
+    namespaces = f' xmlns:xlink="{xlink_namespace}"' if xlink else ""
+    return f"""<svg xmlns="http://www.w3.org/2000/svg"{namespaces} viewBox="{window_x} {window_y} {window_w} {window_h}" width="{screen_w}" height="{screen_h}" > {content} </svg>"""
+
+def svg_panel(panel, oversize_method="truncate"):
+    # Renders any panel-like object with x,y,w,h, a style and get_label()
+    th = panel.style['margin_top']*panel.h
+    return titled_panel(panel.x, panel.y, panel.w, panel.h, th*0.2, th*0.8,
+                        panel.get_label(), oversize_method=oversize_method)
+
+def panel_title(panel):
+    # (r, th, title rectangle) of a panel's title bar, as svg_panel lays it out
+    th = panel.style['margin_top']*panel.h
+    r, th = th*0.2, th*0.8
+    return r, th, (panel.x+r, panel.y+(r/2), panel.w-(2*r), th-r)
+
+def fitted_panel(panel, transform, spans, fontsize=32):
+    # Renders a panel whose title text was already fitted by fit_text
+    r, th, _ = panel_title(panel)
+    return panel_outline(panel.x, panel.y, panel.w, panel.h, r, th) + \
+           text_group(panel.get_label(), (transform[0], 0, 0, transform[3], transform[4], transform[5]), spans, fontsize)
+
+def fitted_renderer(panels, oversize_method, draw):
+    # Fits the titles of all panels in one fit_text call, returning the panels as a
+    # list and a function that draws each, in that order, with draw(panel, transform, spans)
+    panels = list(panels)
+    transforms, spans = fit_text([p.get_label() for p in panels], [panel_title(p)[2] for p in panels],
+                                 oversize_method)
+    fits = iter(zip(transforms.tolist(), spans))
+    return panels, lambda panel: draw(panel, *next(fits))
+
+def svg_stream(panels, window_x, window_y, window_w, window_h, screen_w, screen_h, oversize_method="truncate",
+               render=None, xlink=False, fitted=False):
+    """Yields an SVG document chunk by chunk, one chunk per panel of panels, which
+    should be given in paint order (e.g. Panel.paint_order()). Joining the chunks
+    gives the same document as svg_viewbox over the joined titled panels. render,
+    if given, replaces svg_panel as the function drawing each panel. fitted fits
+    every title up front with fit_text, from glyph tables, instead of one at a
+    time with PIL, which is much faster for large trees though not byte-identical."""
+    if fitted:
+        panels, render = fitted_renderer(panels, oversize_method, fitted_panel)
+    head, tail = svg_viewbox(window_x, window_y, window_w, window_h, screen_w, screen_h, "\0", xlink).split("\0")
+    yield head
+    sep = ""
+    for panel in panels:
+        count("panels_rendered")
+        yield sep + (svg_panel(panel, oversize_method) if render is None else render(panel))
+        sep = "\n"
+    yield tail
+
+def write_svg(fp, panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+              oversize_method="truncate", encoding=None, render=None, fitted=False):
+    # Streams the document to any file-like object; pass an encoding for binary
+    # streams such as gzip files or sockets.
+    for chunk in svg_stream(panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                            oversize_method, render, fitted=fitted):
+        fp.write(chunk if encoding is None else chunk.encode(encoding))
+
+class CompactSVG(object):
+    """Settings and per-document state for compact output. Shared presentation
+    moves into a style sheet, with a class per entry of styles, whose optional
+    title_fill, canvas_fill and stroke keys override the usual pink, white and
+    black. Coordinates are rounded to precision decimal places, and panels whose
+    outlines match an earlier one in shape and style <use> it rather than
+    repeating its paths. titles keeps the <title> copy of each label."""
+
+    def __init__(self, styles=None, precision=2, titles=False, reuse=True):
+        self.styles = styles or {}
+        self.precision = precision
+        self.titles = titles
+        self.reuse = reuse
+        self.style_ids = {id(v):k for k,v in self.styles.items()}
+        self.shapes = {}
+
+    def num(self, v, extra=0):
+        s = f"{v:.{self.precision+extra}f}"
+        if "." in s:
+            s = s.rstrip("0").rstrip(".")
+        return "0" if s == "-0" else s
+
+    def style_sheet(self):
+        rules = [".t,.c{stroke:black;stroke-width:1}", ".t{fill:pink}", ".c{fill:white}", ".l{font-size:32px}"]
+        for name, style in self.styles.items():
+            for cls, key, prop in (("t", "title_fill", "fill"), ("c", "canvas_fill", "fill"),
+                                   ("t", "stroke", "stroke"), ("c", "stroke", "stroke")):
+                if key in style:
+                    rules.append(f".{cls}.{self.style_class(name)}{{{prop}:{style[key]}}}")
+        return "<style>" + "".join(rules) + "</style>"
+
+    def style_class(self, name):
+        return "s-" + re.sub("[^A-Za-z0-9_-]", "_", str(name))
+
+    def style_name(self, style):
+        if id(style) not in self.style_ids:
+            self.style_ids[id(style)] = next((k for k,v in self.styles.items() if v == style), None)
+        return self.style_ids[id(style)]
+
+    def outline(self, panel, r, th):
+        name = self.style_name(panel.style)
+        classes = "" if name is None else " " + self.style_class(name)
+        shape = (name, self.num(panel.w), self.num(panel.h), self.num(r), self.num(th))
+        if self.reuse and shape in self.shapes:
+            k, x0, y0 = self.shapes[shape]
+            return f'<use xlink:href="#o{k}" x="{self.num(panel.x - x0)}" y="{self.num(panel.y - y0)}"/>'
+        n = self.num
+        x, y, w, h, r, th = panel.x, panel.y, panel.w, panel.h, r, th
+        title_path = f"M{n(x)} {n(y+th)}L{n(x)} {n(y+r)}Q{n(x)} {n(y)} {n(x+r)} {n(y)}L{n(x+w-r)} {n(y)}Q{n(x+w)} {n(y)} {n(x+w)} {n(y+r)}L{n(x+w)} {n(y+th)}Z"
+        canvas_path = f"M{n(x+w)} {n(y+th)}L{n(x+w)} {n(y+h-r)}Q{n(x+w)} {n(y+h)} {n(x+w-r)} {n(y+h)}L{n(x+r)} {n(y+h)}Q{n(x)} {n(y+h)} {n(x)} {n(y+h-r)}L{n(x)} {n(y+th)}Z"
+        paths = f'<path class="t{classes}" d="{title_path}"/><path class="c{classes}" d="{canvas_path}"/>'
+        if not self.reuse:
+            return paths
+        k = len(self.shapes)
+        self.shapes[shape] = (k, x, y)
+        return f'<g id="o{k}">{paths}</g>'
+
+    def text(self, text, transform, spans):
+        # Scale terms multiply whole lines of text, so they keep three more places
+        matrix = " ".join(self.num(v, 3 if e < 4 else 0) for e,v in enumerate(transform))
+        title = f"<title>{escape(text)}</title>" if self.titles else ""
+        lines = "".join(f'<tspan x="0" y="{self.num(y)}">{escape(s)}</tspan>' for s,y in spans)
+        return f'<text class="l" transform="matrix({matrix})">{title}{lines}</text>'
+
+    def panel(self, panel, oversize_method="truncate"):
+        transform, spans, fontsize = text_layout(panel.get_label(), panel_title(panel)[2], oversize_method)
+        return self.fitted_panel(panel, transform, spans)
+
+    def fitted_panel(self, panel, transform, spans):
+        # As panel, for title text already fitted, by text_layout or fit_text
+        r, th, _ = panel_title(panel)
+        return self.outline(panel, r, th) + self.text(panel.get_label(), transform, spans)
+
+def compact_stream(panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                   oversize_method="truncate", compact=None, fitted=False):
+    # As svg_stream, in the compact form described by a CompactSVG
+    compact = CompactSVG() if compact is None else compact
+    if fitted:
+        panels, render = fitted_renderer(panels, oversize_method, compact.fitted_panel)
+    else:
+        render = lambda panel: compact.panel(panel, oversize_method)
+    stream = svg_stream(panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                        render=render, xlink=compact.reuse)
+    yield next(stream) + compact.style_sheet()
+    yield from stream
+
+def write_compact_svg(fp, panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                      oversize_method="truncate", compact=None, encoding=None, fitted=False):
+    for chunk in compact_stream(panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                                oversize_method, compact, fitted):
+        fp.write(chunk if encoding is None else chunk.encode(encoding))
+
+def write_svgz(path, panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+               oversize_method="truncate", compact=None, compresslevel=9, fitted=False):
+    # Writes gzip-compressed SVG, compact unless compact is False
+    with gzip.open(path, "wb", compresslevel=compresslevel) as fp:
+        if compact is False:
+            write_svg(fp, panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                      oversize_method, encoding="utf-8", fitted=fitted)
+        else:
+            write_compact_svg(fp, panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                              oversize_method, compact, encoding="utf-8", fitted=fitted)
+
+def compact_report(panels, window_x, window_y, window_w, window_h, screen_w, screen_h, styles=None,
+                   precisions=(0, 1, 2, 3), oversize_method="truncate"):
+    """Sizes of the full and compact outputs, plain and gzipped, at each precision,
+    with the largest on-screen position error rounding can introduce, in pixels."""
+    panels = list(panels)
+    scale = min(screen_w/window_w, screen_h/window_h)
+    def sizes(chunks):
+        document = "".join(chunks).encode("utf-8")
+        return len(document), len(gzip.compress(document))
+    full, full_gz = sizes(svg_stream(panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                                     oversize_method))
+    report = [{ "precision" : None, "bytes" : full, "gzip_bytes" : full_gz, "ratio" : 1.0, "max_error_px" : 0.0 }]
+    for precision in precisions:
+        size, size_gz = sizes(compact_stream(panels, window_x, window_y, window_w, window_h, screen_w, screen_h,
+                                             oversize_method, CompactSVG(styles, precision)))
+        # Reused outlines are offset from a rounded origin, so two roundings can add up
+        report.append({ "precision" : precision, "bytes" : size, "gzip_bytes" : size_gz, "ratio" : size/full,
+                        "max_error_px" : 10.0**-precision * scale })
+    return report
 
 def svg_rect(x,y,w,h, content=""):
     return f"""<rect x="{x}" y="{y}" width="{w}" height="{h}" stroke="black" stroke-width="1" fill="green" opacity="0.85"> {content} </rect>"""
@@ -27,21 +366,28 @@ def titled_panel(x,y,w,h,r,th,text,oversize_method="truncate"):
     t_box = text_rectangle(text, title_rect, oversize_method)
     return cpath + t_box
 
-def graphicaltextsize(text, fontsize=14):
-    image = Image.new("RGB", (20,20))
-    draw = ImageDraw.Draw(image)
-    font = ImageFont.truetype(arial, fontsize)
-    bbox = draw.textbbox((0,0), text, font)
+def _textsize(font, text):
+    bbox = font_cache.draw().textbbox((0,0), text, font)
     return (bbox[2], bbox[3])
 
-def fontmetrics(text, fontsize=14):
-    font = ImageFont.truetype(arial, fontsize)
+def _fontmetrics(font, text):
     ascent, descent = font.getmetrics()
     (width, baseline), (offset_x, offset_y) = font.font.getsize(text)
     return width, ascent + descent - offset_y, baseline
 
+def graphicaltextsize(text, fontsize=14):
+    return font_cache.measure("textsize", arial, fontsize, text, _textsize)
+
+def fontmetrics(text, fontsize=14):
+    return font_cache.measure("fontmetrics", arial, fontsize, text, _fontmetrics)
+
 def text_rectangle(text, rectangle, oversize_method="truncate"):
-    fontsize = 32
+    count("text_fits")
+    with phase("text_rectangle"):
+        return text_group(text, *text_layout(text, rectangle, oversize_method))
+
+def text_layout(text, rectangle, oversize_method="truncate", fontsize=32):
+    # The transform and (line, y offset) spans that fit text to rectangle
     x,y,w,h = rectangle
     ptext,ph = prepare_text(text, (w*1.6, h), oversize_method)
     refbb = graphicaltextsize(ptext, fontsize)
@@ -55,48 +401,150 @@ def text_rectangle(text, rectangle, oversize_method="truncate"):
 
     stext = ptext.split("\n")
     l_height = rh/len(stext)
-    spans = [f"""<tspan x="0" y="%%yoffset%%" >{s} </tspan> \n""" for e,s in enumerate(stext)]
     offsets=[]
     for e,l in enumerate(stext):
         offsets.append((0, e * l_height))
-    spans = [l.replace("%%yoffset%%", str(offsets[e][1])) for e,l in enumerate(spans)]
-    return f"""<g transform="matrix({scale_x} 0 0 {scale_y} {x} {y+loc_y})" ><text x="{0}" y="{0}" style="font-size:{fontsize};"><title>{text}</title>{"".join(spans)}</text>\n</g>"""
+    return (scale_x, 0, 0, scale_y, x, y+loc_y), [(l, offsets[e][1]) for e,l in enumerate(stext)], fontsize
 
+def text_group(text, transform, spans, fontsize=32):
+    spans = [f"""<tspan x="0" y="{yoffset}" >{s} </tspan> \n""" for s,yoffset in spans]
+    matrix = " ".join([str(v) for v in transform])
+    return f"""<g transform="matrix({matrix})" ><text x="{0}" y="{0}" style="font-size:{fontsize};"><title>{text}</title>{"".join(spans)}</text>\n</g>"""
 
+def fit_text(texts, rectangles, oversize_method="truncate", fontsize=32):
+    """Batch equivalent of text_rectangle for a whole list of labels, measured from
+    glyph tables rather than drawn with PIL. Returns an (n,6) array of transform
+    matrices, and for each label its list of (line, y offset) spans."""
+    count("text_fits", len(texts))
+    with phase("fit_text"):
+        return _fit_text(texts, rectangles, oversize_method, fontsize)
 
-def scorechar(c, loc, target, bchars):
-    score=0
-    adj=1/target
-    neg=0
-    if c in bchars:
-        if loc>target:
-            neg=((loc-target)**3)
-        score = 1 / ((( loc-target) **2 ) + 1 + neg)
-    else:
-        score = 1 / ((( loc-target) **2 ) + 1) *(adj**2)
-    return score
+def _fit_text(texts, rectangles, oversize_method="truncate", fontsize=32):
+    linespace=1.2
+    n = len(texts)
+    if n == 0:
+        return np.zeros((0,6)), []
+    x, y, w, h = np.asarray(rectangles, dtype=float).reshape(n,4).T
+    small = font_cache.glyph_table(arial, 14)
+    large = font_cache.glyph_table(arial, fontsize)
+
+    # Oversize handling, following prepare_text, for the labels that need it
+    tw, ttop, tbottom = small.measure_lines(texts)
+    th = (small.ascent + small.descent - ttop) * linespace
+    with np.errstate(divide="ignore", invalid="ignore"):
+        aspect = (tw/th) / ((w*1.6)/h)
+    ptexts = list(texts)
+    for i in np.flatnonzero(aspect > 1.2).tolist():
+        text, cw = texts[i], len(texts[i])
+        if oversize_method.lower()=="wrap":
+            ptexts[i] = "\n".join(wrap_text(text, tw[i]/sqrt(aspect[i]))[0])
+        elif oversize_method.lower()=="truncate":
+            ptexts[i] = text[:int(cw*(w[i]*1.6/tw[i]))-3]+"..."
+
+    # Reference boxes at the drawing size, one line at a time
+    lines = [p.split("\n") for p in ptexts]
+    counts = np.fromiter((len(l) for l in lines), dtype=np.int64, count=n)
+    firsts = np.cumsum(counts) - counts
+    lw, ltop, lbottom = large.measure_lines([l for ls in lines for l in ls])
+    rw = np.ceil(np.maximum.reduceat(lw, firsts))
+    rh = (counts-1) * large.line_spacing + lbottom[firsts+counts-1]
+    # fontmetrics measures multiline text as one run, newline glyphs included
+    multiline = counts > 1
+    fb = np.where(multiline, np.maximum(np.maximum.reduceat(lbottom, firsts), large.bottom[10]),
+                  np.maximum.reduceat(lbottom, firsts)) - \
+         np.where(multiline, np.minimum(np.minimum.reduceat(ltop, firsts), large.top[10]),
+                  np.minimum.reduceat(ltop, firsts))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale_x = np.where(rw > 0, w/rw, 1.0)
+        scale_y = np.where(rh > 0, h/rh, 1.0)
+    morph = scale_x/scale_y
+    scale_x = np.where(morph > 2, scale_x/morph, scale_x)
+    zeros = np.zeros(n)
+    transforms = np.column_stack([scale_x, zeros, zeros, scale_y, x, y+(fb*scale_y)])
+    l_heights = (rh/counts).tolist()
+    spans = [[(l, e*l_heights[i]) for e,l in enumerate(ls)] for i,ls in enumerate(lines)]
+    return transforms, spans
+
+def text_rectangles(texts, rectangles, oversize_method="truncate", fontsize=32):
+    transforms, spans = fit_text(texts, rectangles, oversize_method, fontsize)
+    return [text_group(t, (m[0], 0, 0, m[3], m[4], m[5]), s, fontsize)
+            for t,m,s in zip(texts, transforms.tolist(), spans)]
 
-def word_wrap(text, target_length):
-    linespace = 1.2
-    breakchars = " ,.-"
-    delchars = "\n\t"
+
+
+breakchars = " ,.-"
+delchars = "\n\t"
+_segment_rx = re.compile(f"[^{re.escape(breakchars)}]*[{re.escape(breakchars)}]+|[^{re.escape(breakchars)}]+")
+
+def break_segments(text):
+    # Splits text, in one pass, into the runs between break candidates; each
+    # segment ends just after a run of break characters, which stay on its line.
     for c in delchars:
         text = text.replace(c," ")
-    best_split = 0
-    texts = []
-    finished=False
-    stext = "".join([t for t in text])
-    while not finished and len(stext)!=0:
-        osp = [scorechar(c,e,target_length, breakchars) for e,c in enumerate(stext)]
-        best_split = osp.index(max(osp))
-
-        if len(stext)==0 or best_split==0 or (target_length*linespace)>=len(stext):
-            texts.append(stext)
-            finished=True
-        else:
-            texts.append(stext[:best_split+1])
-        stext = stext[best_split+1:]
-    return texts
+    return _segment_rx.findall(text)
+
+def break_lines(widths, trailing, max_width, method="greedy"):
+    """Chooses line breaks between segments of the given widths, where trailing
+    is the part of each segment's width (trailing spaces) that does not count
+    at the end of a line. Returns the index of the first segment of each line.
+    "greedy" fills each line in turn, "optimal" minimises the squared slack of
+    every line but the last, Knuth-Plass style. A segment wider than max_width
+    gets a line of its own."""
+    n = len(widths)
+    if n == 0:
+        return []
+    ends = np.cumsum(widths)
+    starts = ends - widths
+    fitted = ends - trailing # width of a line ending at each segment
+    if method == "greedy":
+        breaks = [0]
+        for j in range(1, n):
+            if fitted[j] - starts[breaks[-1]] > max_width:
+                breaks.append(j)
+        return breaks
+    elif method == "optimal":
+        cost = np.full(n+1, np.inf)
+        cost[0] = 0
+        best = np.zeros(n+1, dtype=np.int64)
+        for j in range(1, n+1):
+            # Candidate lines i..j-1, scanned back only as far as they fit
+            for i in range(j-1, -1, -1):
+                width = fitted[j-1] - starts[i]
+                if width > max_width and i < j-1:
+                    break
+                slack = 0 if j == n else (max_width - width) ** 2
+                if cost[i] + slack < cost[j]:
+                    cost[j] = cost[i] + slack
+                    best[j] = i
+        breaks = []
+        j = n
+        while j > 0:
+            breaks.append(best[j])
+            j = best[j]
+        return breaks[::-1]
+    raise ValueError(f"Unknown line breaking method {method!r}")
+
+def _join_lines(segments, breaks):
+    return ["".join(segments[b:e]) for b,e in zip(breaks, breaks[1:]+[len(segments)])]
+
+def word_wrap(text, target_length, method="greedy"):
+    # Wraps to a target number of characters per line
+    segments = break_segments(text)
+    widths = np.array([len(s) for s in segments], dtype=float)
+    trailing = widths - np.array([len(s.rstrip(" ")) for s in segments], dtype=float)
+    return _join_lines(segments, break_lines(widths, trailing, target_length, method))
+
+def wrap_text(text, max_width, fontsize=14, method="greedy", linespace=1.2):
+    """Wraps text to max_width pixels at fontsize, measuring each break segment
+    from the font's glyph table. Returns the lines, and the height in pixels of
+    the wrapped block."""
+    table = font_cache.glyph_table(arial, fontsize)
+    segments = break_segments(text)
+    widths, tops, bottoms = table.measure_lines(segments + [s.rstrip(" ") for s in segments])
+    widths, stripped = widths[:len(segments)], widths[len(segments):]
+    lines = _join_lines(segments, break_lines(widths, widths - stripped, max_width, method))
+    return lines, len(lines) * (table.ascent + table.descent) * linespace
 
 def prepare_text(text, bounding_box, oversize_method="wrap"):
 
@@ -111,9 +559,9 @@ def prepare_text(text, bounding_box, oversize_method="wrap"):
     text_height = 1
     if aspect > 1.2:
         if oversize_method.lower()=="wrap":
-            wt = int(cw/sqrt(tar/bar))
-            ww = word_wrap(text, wt)
-            return "\n".join(ww), (bh/len(ww))/linespace
+            lines, block_height = wrap_text(text, tw/sqrt(aspect), linespace=linespace)
+            # The font size at which the wrapped block, measured at 14px, just fills the box
+            return "\n".join(lines), 14 * bh / block_height
         elif oversize_method.lower()=="truncate":
             return text[:int(cw*(bw/tw))-3]+"...", bh
     elif aspect < 0.8:
@@ -0,0 +1,135 @@
+import copy
+import json
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import datasources
+from paneltree import PanelTree, apply_delta
+
+# PanelTree.update against full rebuilds. Each test updates a tree for a change
+# of rows, styles, layouts, labels or fields, and compares the result, panel by
+# panel, with a tree built from scratch by PanelTree.build.
+
+with open(os.path.join(os.path.dirname(__file__), "..", "styles.json"), "r") as j:
+    styles = json.load(j)
+
+specs = { "columns-rows-block" : ("columns", "rows", "block"),
+          "fill-block" : ("fill", "block"),
+          "columns-matrix" : ("columns", "matrix"),
+          "columns-rows-matrix" : ("columns", "rows", "matrix"),
+          "matrix-fill-columns" : ("matrix", "fill", "columns") }
+
+box = dict(x=0.0, y=0.0, w=1600.0, h=1200.0)
+
+
+def hierarchy(rows=600, depth=3, fanout=4, seed=0):
+    # level0 to level{depth-1}, each splitting every group above into up to fanout
+    # children, plus a band column for the second field of matrix levels
+    rng = np.random.default_rng(seed)
+    code = np.zeros(rows, dtype=np.int64)
+    data = {}
+    for level in range(depth):
+        code = code * fanout + rng.integers(0, fanout, size=rows)
+        data[f"level{level}"] = np.array([f"L{level}-{c}" for c in code.tolist()], dtype=object)
+    data["band"] = np.array([f"B{b}" for b in rng.integers(0, 3, size=rows).tolist()], dtype=object)
+    data["value"] = rng.integers(0, 1000, size=rows)
+    data["__all__"] = True
+    return pd.DataFrame(data)
+
+def specification(layouts):
+    spec = { "root" : { "partition" : {"template" : "Canvas", "fields" : ["__all__"], "layout" : "fill"},
+                        "style" : "red", "label" : "Diagram" },
+             "Canvas" : { "style" : "green", "label" : "Canvas" } }
+    previous = "Canvas"
+    for level, layout in enumerate(layouts):
+        fields = [f"level{level}", "band"] if layout == "matrix" else [f"level{level}"]
+        spec[previous]["partition"] = { "template" : f"Level{level}", "fields" : fields,
+                                        "layout" : layout, "spacing" : 0.02 }
+        spec[f"Level{level}"] = { "style" : ("blue", "yellow", "red")[level % 3], "label" : f"%%level{level}%%" }
+        previous = f"Level{level}"
+    return spec
+
+def random_delta(data, rng, fraction=0.05):
+    # Deletes, updates and inserts about fraction of the rows each. Updates move rows
+    # to values seen elsewhere in their column, so they change branches.
+    n = max(int(len(data) * fraction), 1)
+    deletes = rng.choice(data.index, size=n, replace=False)
+    kept = data.index.difference(deletes)
+    moved = rng.choice(kept, size=n, replace=False)
+    fields = [c for c in data.columns if c.startswith("level") or c == "band"]
+    updates = {f:rng.choice(data[f].unique(), size=n) for f in rng.choice(fields, size=2, replace=False)}
+    inserts = data.loc[rng.choice(kept, size=n, replace=False)].copy()
+    inserts.index = data.index.max() + 1 + np.arange(n)
+    inserts["value"] = rng.integers(0, 1000, size=n)
+    return apply_delta(data, inserts, deletes, pd.DataFrame(updates, index=moved))
+
+def panels(tree):
+    return [(p.name, p.template, p.x, p.y, p.w, p.h, p.get_label(), p.count, p.depth,
+             p.parent.name if p.parent else None) for p in tree.paint_order()]
+
+def assert_rebuilt(tree, data, spec, styles):
+    assert panels(tree) == panels(PanelTree.build(data, spec, styles, **box))
+
+def spec_edits(layouts):
+    # (name, edit) pairs changing the spacing, labels, fields and layout of each level
+    edits = []
+    for level, layout in enumerate(layouts):
+        parent = "Canvas" if level == 0 else f"Level{level-1}"
+        edits.append((f"spacing-{level}", lambda s, p=parent: s[p]["partition"].update(spacing=0.05)))
+        edits.append((f"label-{level}", lambda s, l=level: s[f"Level{l}"].update(label=f"%%level{l}%% (%%value%%)")))
+        edits.append((f"fields-{level}", lambda s, p=parent: s[p]["partition"].update(fields=["band"], layout="columns")))
+        if layout != "matrix":
+            other = "columns" if layout == "rows" else "rows"
+            edits.append((f"layout-{level}", lambda s, p=parent, o=other: s[p]["partition"].update(layout=o)))
+    return edits
+
+
+@pytest.fixture
+def data():
+    return hierarchy()
+
+@pytest.mark.parametrize("layouts", specs.values(), ids=specs.keys())
+def test_row_deltas(data, layouts):
+    spec, rng = specification(layouts), np.random.default_rng(1)
+    tree = PanelTree.build(data, spec, styles, **box)
+    for _ in range(4):
+        data = random_delta(data, rng)
+        tree, changes = tree.update(data)
+        assert_rebuilt(tree, data, spec, styles)
+
+@pytest.mark.parametrize("layouts", specs.values(), ids=specs.keys())
+@pytest.mark.parametrize("template", ["root", "Level0", "lowest"])
+def test_style_only(data, layouts, template):
+    spec = specification(layouts)
+    template = f"Level{len(layouts)-2}" if template == "lowest" else template
+    changed = copy.deepcopy(styles)
+    changed[spec[template]["style"]]["margin_left"] += 0.01
+    tree, changes = PanelTree.build(data, spec, styles, **box).update(styles=changed)
+    assert_rebuilt(tree, data, spec, changed)
+
+@pytest.mark.parametrize("layouts", specs.values(), ids=specs.keys())
+def test_spec_changes(data, layouts):
+    spec = specification(layouts)
+    tree = PanelTree.build(data, spec, styles, **box)
+    for name, edit in spec_edits(layouts):
+        changed = copy.deepcopy(spec)
+        edit(changed)
+        updated, changes = tree.update(specification=changed)
+        assert panels(updated) == panels(PanelTree.build(data, changed, styles, **box)), name
+
+@pytest.mark.parametrize("layouts", specs.values(), ids=specs.keys())
+def test_lazy_tree(data, layouts):
+    spec = specification(layouts)
+    tree = PanelTree.build(data, spec, styles, viewport=(0.0, 0.0, 600.0, 1200.0), min_size=120.0, **box)
+    delta = random_delta(data, np.random.default_rng(2))
+    updated, changes = tree.update(delta)
+    updated.expand()
+    assert_rebuilt(updated, delta, spec, styles)
+
+def test_aggregate_source_refused(data):
+    # Aggregated sources number their rows by input row, so cannot be updated
+    spec = specification(specs["columns-rows-block"])
+    source = datasources.AggregateSource(datasources.aggregate_chunks([data], spec))
+    with pytest.raises(ValueError):
+        PanelTree.build(source, spec, styles, **box).update(specification=spec)